@@ -0,0 +1,255 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import src.retimer.retimer as rt
+import src.utils.utilities as utils
+from src.opt import opt
+from src.opt.cp import clock_period
+from src.wd import wd
+
+PHASES = ('load', 'parse', 'preprocess', 'wd', 'opt1', 'opt2', 'cp')
+DIRECTORIES = ('perf-graphs/clean', 'corr-graphs', 'rand-graphs/clean')
+# scripts whose import time is checked, and the heavy modules a plain retiming must not import
+SCRIPTS = ('run',)
+LAZY_MODULES = ('networkx', 'scipy', 'matplotlib', 'pygraphviz', 'memory_profiler')
+
+# run in a fresh interpreter: import a module and print the time it took and the lazy modules it loaded anyway
+_IMPORT_PROBE = '''
+import json, sys, time
+init = time.perf_counter()
+__import__(sys.argv[1])
+seconds = time.perf_counter() - init
+print(json.dumps({'seconds': seconds, 'loaded': [name for name in sys.argv[2:] if name in sys.modules]}))
+'''
+
+
+def benchmark(directories, phases=PHASES, repeats=5, warmup=1, sample=3):
+    """
+    Time each phase of the retiming on the circuits of the given directories. Each phase is run warmup times
+    without being measured, then repeats times, and the median of the repeats is its time. The phases are:
+    - load: read the .dot file as a networkx graph
+    - parse: read the .dot file as a circuit with the streaming parser
+    - preprocess: convert the networkx graph to a circuit inside the retimer
+    - wd: compute W and D
+    - opt1, opt2: search the minimum clock with the Bellman Ford and the FEAS checker, W and D given
+    - cp: clock period of the circuit as it is
+    :param directories: directories of the circuits, each one a group of the complexity fits
+    :param phases: the phases to time
+    :param repeats: measured runs of each phase
+    :param warmup: runs of each phase before the measured ones
+    :param sample: at most this number of circuits from each directory and subdirectory, all of them if None
+    :return: the report, with the environment, the time of each phase of each circuit and the complexity fits
+    """
+    results = []
+    for directory in directories:
+        for path in _circuit_files(directory, sample):
+            print(path)
+            results.extend(_benchmark_circuit(path, directory, phases, repeats, warmup))
+
+    return {'environment': _environment(), 'repeats': repeats, 'warmup': warmup, 'results': results,
+            'fits': fit_exponents(results)}
+
+
+def _benchmark_circuit(path: str, group: str, phases, repeats: int, warmup: int):
+    """
+    :return: a result for each phase of the circuit
+    """
+    graph = utils.load_graph(path)
+    circuit = utils.load_circuit(path)
+    matrices = None
+    if 'opt1' in phases or 'opt2' in phases:
+        matrices = wd.WD(circuit)
+        _quiet(matrices.wd)
+
+    measured = {
+        'load': lambda: utils.load_graph(path),
+        'parse': lambda: utils.load_circuit(path),
+        'preprocess': lambda: rt.Retimer(graph.copy()),
+        'wd': lambda: wd.WD(circuit).wd(),
+        'opt1': lambda: opt.OPT(circuit, matrices.w, matrices.d).opt('opt1'),
+        'opt2': lambda: opt.OPT(circuit, matrices.w, matrices.d).opt('opt2'),
+        'cp': lambda: clock_period(circuit, circuit.wire_delay),
+    }
+
+    results = []
+    for phase in phases:
+        samples = _time(measured[phase], repeats, warmup)
+        results.append({'path': path, 'group': group, 'nodes': len(circuit), 'edges': len(circuit.src),
+                        'phase': phase, 'samples': samples, 'median': float(np.median(samples)),
+                        'min': min(samples)})
+        print("  {} {:.6f}".format(phase, results[-1]['median']))
+    return results
+
+
+def _time(function, repeats: int, warmup: int):
+    """
+    :return: the duration of each measured run, in seconds
+    """
+    for _ in range(warmup):
+        _quiet(function)
+    samples = []
+    for _ in range(repeats):
+        init = time.perf_counter()
+        _quiet(function)
+        samples.append(time.perf_counter() - init)
+    return samples
+
+
+def _quiet(function):
+    """
+    Run the function hiding what the algorithms print
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function()
+
+
+def _circuit_files(directory: str, sample):
+    """
+    :return: the .dot files of the directory and its subdirectories, at most sample from each one
+    """
+    paths = []
+    for root, subdirectories, names in os.walk(directory):
+        subdirectories.sort()
+        files = sorted(name for name in names if name.endswith('.dot'))
+        paths.extend(os.path.join(root, name) for name in files[:sample])
+    return paths
+
+
+def _environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'processor': platform.processor(), 'cpus': os.cpu_count(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def import_times(scripts=SCRIPTS, repeats=5):
+    """
+    Time the import of each script in fresh interpreters, which is what a shell pipeline calling it on many small
+    circuits pays every time
+    :param scripts: the modules to import, from the directory of this file
+    :param repeats: interpreters started for each script
+    :return: the durations of each script in seconds, their median and the LAZY_MODULES loaded by the import
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for script in scripts:
+        samples, loaded = [], set()
+        for _ in range(repeats):
+            output = subprocess.run([sys.executable, '-c', _IMPORT_PROBE, script] + list(LAZY_MODULES), cwd=directory,
+                                    check=True, capture_output=True, text=True).stdout
+            probe = json.loads(output.splitlines()[-1])
+            samples.append(probe['seconds'])
+            loaded.update(probe['loaded'])
+        results.append({'script': script, 'samples': samples, 'median': float(np.median(samples)),
+                        'loaded': sorted(loaded)})
+        print("import {} {:.6f}".format(script, results[-1]['median']))
+    return results
+
+
+def import_regressions(imports, budget=0.5):
+    """
+    :param imports: the results of import_times
+    :param budget: seconds the import of a script may take
+    :return: the scripts over the budget or importing one of the LAZY_MODULES
+    """
+    return [result for result in imports if result['median'] > budget or result['loaded']]
+
+
+def fit_exponents(results):
+    """
+    Fit time = c * nodes^k by least squares on the logarithms, for each group of circuits and phase. This is the
+    empirical counterpart of the estimations in the README: k is compared with the exponent of the complexity.
+    Only the groups with at least three different sizes are fitted.
+    :param results: the results of benchmark
+    :return: the exponent k, the constant c and the R^2 of the fit of each group and phase
+    """
+    series = {}
+    for result in results:
+        if result['median'] > 0:
+            series.setdefault((result['group'], result['phase']), []).append((result['nodes'], result['median']))
+
+    fits = []
+    for (group, phase), points in sorted(series.items()):
+        sizes = np.log([nodes for nodes, _ in points])
+        times = np.log([median for _, median in points])
+        if len(np.unique(sizes)) < 3:
+            continue
+        exponent, constant = np.polyfit(sizes, times, 1)
+        residuals = times - (exponent * sizes + constant)
+        total = np.sum((times - np.mean(times)) ** 2)
+        r2 = 1 - np.sum(residuals ** 2) / total if total > 0 else 1.0
+        fits.append({'group': group, 'phase': phase, 'exponent': float(exponent),
+                     'constant': float(np.exp(constant)), 'r2': float(r2), 'circuits': len(points)})
+    return fits
+
+
+def regressions(report: dict, baseline: dict, threshold=0.25, floor=0.005):
+    """
+    Compare the median times of a report with the ones of a baseline report
+    :param report:
+    :param baseline:
+    :param threshold: relative slowdown over which a phase regresses, 0.25 is 25% slower
+    :param floor: slowdowns below this number of seconds are noise and never regress
+    :return: the phases of the circuits slower than in the baseline
+    """
+    reference = {(result['path'], result['phase']): result['median'] for result in baseline['results']}
+    slower = []
+    for result in report['results']:
+        before = reference.get((result['path'], result['phase']))
+        if before is None:
+            continue
+        after = result['median']
+        if after > before * (1 + threshold) and after - before > floor:
+            slower.append({'path': result['path'], 'phase': result['phase'], 'baseline': before, 'median': after,
+                           'ratio': after / before if before > 0 else float('inf')})
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--paths', type=str, nargs='+', default=list(DIRECTORIES),
+                        help='directories of the circuits to time, each one fitted on its own')
+    parser.add_argument('--phases', type=str, nargs='+', default=list(PHASES), choices=PHASES,
+                        help='phases to time')
+    parser.add_argument('--repeats', type=int, default=5, help='measured runs of each phase')
+    parser.add_argument('--warmup', type=int, default=1, help='runs of each phase before the measured ones')
+    parser.add_argument('--sample', type=int, default=3,
+                        help='circuits taken from each directory and subdirectory, 0 for all of them')
+    parser.add_argument('--output', type=str, default='benchmark.json', help='JSON report')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON report to compare with')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='relative slowdown against the baseline that fails the run')
+    parser.add_argument('--floor', type=float, default=0.005,
+                        help='slowdowns below this number of seconds are ignored')
+    parser.add_argument('--importbudget', type=float, default=0.5,
+                        help='seconds the import of run.py may take, it also fails if it loads a plotting, DOT or '
+                             'profiling library')
+    args = parser.parse_args()
+
+    report = benchmark(args.paths, args.phases, args.repeats, args.warmup, args.sample or None)
+    report['imports'] = import_times(repeats=args.repeats)
+    report['import_regressions'] = import_regressions(report['imports'], args.importbudget)
+    for fit in report['fits']:
+        print("{} {}: time ~ nodes^{:.2f} (R^2 {:.2f})".format(fit['group'], fit['phase'], fit['exponent'], fit['r2']))
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            report['regressions'] = regressions(report, json.load(baseline_file), args.threshold, args.floor)
+    with open(args.output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+
+    for slower in report.get('regressions', []):
+        print("regression {} {}: {:.6f} -> {:.6f}".format(slower['path'], slower['phase'], slower['baseline'],
+                                                          slower['median']))
+    for slower in report['import_regressions']:
+        print("import regression {}: {:.6f} s, loads {}".format(slower['script'], slower['median'],
+                                                               ', '.join(slower['loaded']) or 'nothing heavy'))
+    if report.get('regressions') or report['import_regressions']:
+        sys.exit(1)
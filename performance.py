@@ -1,13 +1,12 @@
 import cProfile
 import os
+import tempfile
 import time
 import networkx as nx
-from memory_profiler import profile
 import src.retimer.retimer as rt
 import src.utils.utilities as utils
 
 
-@profile
 def profile_memory(retimer, param):
     retimer.retime(param)
 
@@ -17,7 +16,11 @@ def bench_memory():
     Bench both opt1 and opt2 memory consumption using the graph generated for the performance tests. The execution times
     are printed in the terminal. In order to process bigger rand-graphs and save time, matrices W and D are
     directly passed to the retimer that executes opt2, avoiding to be computed twice per graph.
+    memory_profiler is needed only here, so it is imported by this function.
     """
+    from memory_profiler import profile as memory_profile
+
+    profiled = memory_profile(profile_memory)
     path = os.getcwd() + '/perf-graphs/randomized'
     perf_test = [file for file in os.listdir(path)]
     for file in sorted(perf_test):
@@ -25,11 +28,11 @@ def bench_memory():
         graph = utils.load_graph(path + '/' + file)
         max_clock = max([weight['component_delay'] for (node, weight) in graph.nodes.data()])
         retimer = rt.Retimer(graph.copy())
-        profile_memory(retimer, 'opt1')
+        profiled(retimer, 'opt1')
         assert max_clock == retimer.opt.min_clock
         nretimer = rt.Retimer(graph.copy())
         del retimer
-        profile_memory(nretimer, 'opt2')
+        profiled(nretimer, 'opt2')
         assert max_clock == nretimer.opt.min_clock
         del nretimer
 
@@ -37,19 +40,21 @@ def bench_memory():
 def bench_cpu(test_path: str, randomize=False):
     """
     Bench both opt1 and opt2 execution time using the graph generated for the performance tests. The execution times
-    are printed in the terminal. In order to process bigger rand-graphs and save time, matrices W and D are
-    directly passed to the retimer that executes opt2, avoiding to be computed twice per graph.
+    are printed in the terminal. In order to process bigger rand-graphs and save time, the two retimers share a
+    cache: matrices W and D computed for opt1 are read back by opt2, avoiding to be computed twice per graph.
     """
     path = os.getcwd() + '/' + test_path
     perf_test = [file for file in os.listdir(path)]
     for file in sorted(perf_test):
         print(file)
+        cache_dir = tempfile.TemporaryDirectory()
         graph = utils.load_graph(path + '/' + file)
-        retimer = rt.Retimer(graph.copy())
+        retimer = rt.Retimer(graph.copy(), cache_dir=cache_dir.name)
 
         if randomize is True:
             graph = utils.node_randomizer(retimer.graph)
             nx.nx_agraph.write_dot(graph, path + '/np-{}'.format(file))
+            retimer.graph = graph
 
         max_clock = max([weight['component_delay'] for (node, weight) in graph.nodes.data()])
 
@@ -58,13 +63,12 @@ def bench_cpu(test_path: str, randomize=False):
         end = time.time()
         print("opt1 {}".format(end - init))
         assert max_clock == retimer.opt.min_clock
-        nretimer = rt.Retimer(graph.copy())
-        nretimer.opt.w = retimer.wd.w
-        nretimer.opt.d = retimer.wd.d
+        nretimer = rt.Retimer(graph.copy(), cache_dir=cache_dir.name)
         del retimer
-        nretimer.opt.opt('opt2')
+        nretimer.retime('opt2')
         assert max_clock == nretimer.opt.min_clock
         del nretimer
+        cache_dir.cleanup()
 
 
 def profile(test_path: str, randomize=False):
@@ -83,6 +87,7 @@ def profile(test_path: str, randomize=False):
         if randomize is True:
             graph = utils.node_randomizer(retimer.graph)
             nx.nx_agraph.write_dot(graph, path + 'np-{}'.format(file))
+            retimer.graph = graph
 
         max_clock = max([weight['component_delay'] for (node, weight) in graph.nodes.data()])
         pr = cProfile.Profile()
@@ -1,22 +1,219 @@
-import networkx as nx
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
-from src.utils import utilities
+from src.instrument.instrument import LOAD, Instrument, MemoryRecorder
+from src.utils import export, utilities
 from src.retimer import retimer as rt
+from src.wd import wd
 import argparse
 
 
-def run(path: str, printwd: bool, optimizer: str, output: str):
-    graph = utilities.load_graph(path)
-    retimer = rt.Retimer(graph, printwd)
-    retimer.retime(optimizer)
-    rt.save_graph(retimer.retimed_graph, output)
+def run(path: str, printwd: bool, optimizer: str, output: str, wdengine=wd.DIJKSTRA, wdjobs=None, wdmemmap=None,
+        warmstart=False, searchjobs=1, batched=False, matrixfree=False, wdsparse=False, cache=False,
+        resultcache=None, minarea=False, memreport=False, components=False, componentjobs=None,
+        outputformat=None):
+    instrument = MemoryRecorder() if memreport is True else Instrument()
+    try:
+        init = time.time()
+        with instrument.phase(LOAD, path=path):
+            circuit = utilities.load_circuit(path, cache)
+        loaded = time.time()
+        retimer = rt.Retimer(circuit, printwd, wdengine, wdjobs, wdmemmap, wdsparse, resultcache,
+                             instrument=instrument)
+        retimer.retime(optimizer, warmstart, searchjobs, batched, matrixfree, minarea, components, componentjobs)
+        retimed = time.time()
+        export.export_retiming(retimer.circuit, retimer.opt.retimings, output, outputformat)
+        end = time.time()
+        if memreport is True:
+            instrument.save(memory_report_path(output))
+    finally:
+        if memreport is True:
+            instrument.close()
+    record = {'min_clock': int(retimer.opt.min_clock), 'optimizer': optimizer,
+              'timings': {'load': loaded - init, 'retime': retimed - loaded, 'save': end - retimed,
+                          'total': end - init}}
+    if retimer.opt.registers is not None:
+        record['registers'] = {'before': retimer.opt.registers[0], 'after': retimer.opt.registers[1]}
+    if memreport is True:
+        record['memory'] = {'report': memory_report_path(output), 'peak_bytes': instrument.peak_bytes}
+    return record
+
+
+def memory_report_path(output: str):
+    """
+    :param output: path of the retimed graph
+    :return: path of the memory report written next to it
+    """
+    return os.path.splitext(output)[0] + '.memory.json'
+
+
+def run_batch(directory: str, output: str, jobs=None, summary=None, **options):
+    """
+    Retime all the circuits inside a directory (and its subdirectories) with a pool of processes. The largest
+    circuits are scheduled first so that they do not end up alone at the end of the run. Each retimed graph is
+    saved in the output directory with the same relative path, and a JSON line with its results is appended to
+    the summary as soon as it is done. A circuit that fails is reported in the summary without stopping the others,
+    even if its process dies: the circuits pending in the broken pool are retried each in a process of its own.
+    :param directory: input directory
+    :param output: output directory
+    :param jobs: number of processes, all the CPUs if None
+    :param summary: path of the JSON lines summary, output/summary.jsonl if None
+    :param options: the arguments of run
+    :return: the number of circuits that failed
+    """
+    if summary is None:
+        summary = os.path.join(output, 'summary.jsonl')
+    os.makedirs(output, exist_ok=True)
+    extension = export.EXTENSIONS[options.get('outputformat') or export.DOT]
+    paths = circuit_files(directory)
+    names = {path: os.path.splitext(os.path.relpath(path, directory))[0] for path in paths}
+    outputs = {path: os.path.join(output, names[path] + extension) for path in paths}
+    # each circuit keeps its memory-mapped W and D in its own subdirectory, named like its output
+    job_options = {path: dict(options, wdmemmap=os.path.join(options['wdmemmap'], names[path]))
+                   if options.get('wdmemmap') is not None else options for path in paths}
+    crashed = []
+    failures = 0
+
+    with open(summary, 'w') as summary_file:
+        def write(record: dict):
+            summary_file.write(json.dumps(record) + '\n')
+            summary_file.flush()
+            return 1 if record['status'] == 'failed' else 0
+
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            circuits = {pool.submit(_run_job, path, outputs[path], job_options[path]): path for path in paths}
+            for circuit in as_completed(circuits):
+                try:
+                    record = circuit.result()
+                except BrokenProcessPool:
+                    # a worker died (e.g. killed out of memory) and took the pool down with the circuits pending
+                    crashed.append(circuits[circuit])
+                    continue
+                except Exception as error:
+                    record = {'path': circuits[circuit], 'status': 'failed', 'error': _describe(error)}
+                failures += write(record)
+
+        # each circuit left by a broken pool is retried in a process of its own, so only the one that dies fails
+        crashed.sort(key=paths.index)
+        with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as threads:
+            retried = [threads.submit(_run_isolated, path, outputs[path], job_options[path]) for path in crashed]
+            for circuit in as_completed(retried):
+                failures += write(circuit.result())
+
+    return failures
+
+
+def circuit_files(directory: str):
+    """
+    :param directory:
+    :return: the paths of the circuits inside the directory and its subdirectories, largest first: the .dot files
+    and the .npz files that are not the cache of a .dot one
+    """
+    paths = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            base, extension = os.path.splitext(name)
+            if extension == '.dot' or (extension == '.npz' and base + '.dot' not in names):
+                paths.append(os.path.join(root, name))
+    return sorted(paths, key=os.path.getsize, reverse=True)
+
+
+def _run_job(path: str, output: str, options: dict):
+    """
+    Retime a single circuit of a batch inside a worker process
+    :return: the summary record of the circuit
+    """
+    record = {'path': path, 'output': output, 'optimizer': options.get('optimizer')}
+    try:
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        record.update(run(path, output=output, **options))
+        record['status'] = 'ok'
+    except Exception as error:
+        record['status'] = 'failed'
+        record['error'] = _describe(error)
+    return record
+
+
+def _run_isolated(path: str, output: str, options: dict):
+    """
+    Retime a single circuit of a batch in a process of its own
+    :return: the summary record of the circuit, failed if the process died
+    """
+    try:
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            return pool.submit(_run_job, path, output, options).result()
+    except BrokenProcessPool as error:
+        return {'path': path, 'output': output, 'optimizer': options.get('optimizer'), 'status': 'failed',
+                'error': 'the worker process died: {}'.format(_describe(error))}
+
+
+def _describe(error: Exception):
+    return "{}: {}".format(type(error).__name__, error)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--path', type=str, required=True, help='input graph file path')
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('--path', type=str, help='input graph file path, .dot or .npz')
+    inputs.add_argument('--batch', type=str, help='retime all the .dot and .npz files inside a directory')
     parser.add_argument('--printwd', action='store_true', help='print W and D matrices')
     parser.add_argument('--optimizer', type=str, required=True, help='specify algorithm to use: "opt1" or "opt2"')
-    parser.add_argument('--outputfile', type=str, required=True, help='output graph file path')
+    parser.add_argument('--outputfile', type=str, required=True,
+                        help='output graph file path, or output directory with --batch')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='number of circuits retimed at once with --batch, all the CPUs by default')
+    parser.add_argument('--summary', type=str, default=None,
+                        help='JSON lines summary of --batch, summary.jsonl in the output directory by default')
+    parser.add_argument('--wdengine', type=str, default=wd.DIJKSTRA, choices=wd.ENGINES,
+                        help='all pairs shortest path engine used by WD')
+    parser.add_argument('--wdjobs', type=int, default=None, help='number of processes of the parallel WD engine')
+    parser.add_argument('--wdmemmap', type=str, default=None,
+                        help='directory where W and D are stored as memory-mapped files (out-of-core mode), '
+                             'one subdirectory per circuit with --batch')
+    parser.add_argument('--wdsparse', action='store_true',
+                        help='store only the pairs of W and D that can give an OPT1 constraint')
+    parser.add_argument('--warmstart', action='store_true',
+                        help='start each feasibility check from the solution of the nearest feasible clock')
+    parser.add_argument('--searchjobs', type=int, default=1,
+                        help='number of clocks checked at once by a pool of processes (k-ary search)')
+    parser.add_argument('--batched', action='store_true',
+                        help='check all the candidate clocks in one vectorized pass (opt2 only)')
+    parser.add_argument('--matrixfree', action='store_true',
+                        help='skip the W and D matrices and search among all the integer clocks (opt2 only)')
+    parser.add_argument('--cache', action='store_true',
+                        help='keep a binary .npz copy of each .dot file and load it on the next runs')
+    parser.add_argument('--resultcache', type=str, default=None,
+                        help='directory of a persistent cache of W, D and the clocks already checked for each circuit')
+    parser.add_argument('--minarea', action='store_true',
+                        help='retime with the fewest registers that meet the minimum clock')
+    parser.add_argument('--memreport', action='store_true',
+                        help='trace the memory of each phase and probe and write it next to each output graph as '
+                             '<output>.memory.json')
+    parser.add_argument('--components', action='store_true',
+                        help='retime each weakly connected component on its own, in a pool of processes')
+    parser.add_argument('--componentjobs', type=int, default=None,
+                        help='number of processes of --components, all the CPUs by default')
+    parser.add_argument('--outputformat', type=str, default=None, choices=export.FORMATS,
+                        help='format of the retimed circuit, given by the extension of the output file by default: '
+                             'dot, jsonl, npz, or lags for only the lags and the changed edges (.lags.npz)')
     args = parser.parse_args()
-    run(args.path, args.printwd, args.optimizer, args.outputfile)
+    if args.batch is not None:
+        failed = run_batch(args.batch, args.outputfile, args.jobs, args.summary, printwd=args.printwd,
+                           optimizer=args.optimizer, wdengine=args.wdengine, wdjobs=args.wdjobs,
+                           wdmemmap=args.wdmemmap, warmstart=args.warmstart, searchjobs=args.searchjobs,
+                           batched=args.batched, matrixfree=args.matrixfree, wdsparse=args.wdsparse,
+                           cache=args.cache, resultcache=args.resultcache, minarea=args.minarea,
+                           memreport=args.memreport, components=args.components,
+                           componentjobs=args.componentjobs, outputformat=args.outputformat)
+        if failed > 0:
+            print("{} circuits failed".format(failed))
+            sys.exit(1)
+    else:
+        run(args.path, args.printwd, args.optimizer, args.outputfile, args.wdengine, args.wdjobs, args.wdmemmap,
+            args.warmstart, args.searchjobs, args.batched, args.matrixfree, args.wdsparse, args.cache,
+            args.resultcache, args.minarea, args.memreport, args.components, args.componentjobs,
+            args.outputformat)
@@ -0,0 +1,31 @@
+import argparse
+import asyncio
+
+from src.service.service import DEFAULT_WARM_BYTES, MAX_EDITS, RetimingService
+from src.wd import wd
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    address = parser.add_mutually_exclusive_group(required=True)
+    address.add_argument('--socket', type=str, help='path of the Unix socket to listen on')
+    address.add_argument('--port', type=int, help='localhost TCP port to listen on')
+    parser.add_argument('--jobs', type=int, default=1, help='number of circuits retimed at once')
+    parser.add_argument('--warmbytes', type=int, default=DEFAULT_WARM_BYTES,
+                        help='bytes of the circuits, W and D included, kept in memory between the requests')
+    parser.add_argument('--maxedits', type=int, default=MAX_EDITS,
+                        help='circuits differing from a warm one by more edits are retimed from scratch')
+    parser.add_argument('--wdengine', type=str, default=wd.DIJKSTRA, choices=wd.ENGINES,
+                        help='all pairs shortest path engine used by WD')
+    parser.add_argument('--wdjobs', type=int, default=None, help='number of processes of the parallel WD engine')
+    parser.add_argument('--wdsparse', action='store_true',
+                        help='store only the pairs of W and D that can give an OPT1 constraint')
+    parser.add_argument('--resultcache', type=str, default=None,
+                        help='directory of a persistent cache of W, D and the clocks already checked for each circuit')
+    args = parser.parse_args()
+
+    service = RetimingService(args.jobs, args.warmbytes, args.maxedits, wd_engine=args.wdengine,
+                              wd_jobs=args.wdjobs, wd_sparse=args.wdsparse, cache_dir=args.resultcache)
+    try:
+        asyncio.run(service.serve(path=args.socket, port=args.port))
+    except KeyboardInterrupt:
+        pass
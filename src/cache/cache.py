@@ -0,0 +1,105 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from src.circuit.circuit import Circuit
+
+# Default upper bound on the size of the cache directory
+DEFAULT_SIZE = 1 << 30
+
+
+class Cache:
+    """
+    Persistent cache of the results computed on a circuit, addressed by the hash of the circuit itself.
+    Every circuit has a directory holding one .npy file per array. The directories are evicted in least recently
+    used order (the modification time of a directory is updated at every access) when the cache grows over its size.
+    """
+
+    def __init__(self, directory: str, size=DEFAULT_SIZE):
+        self.directory = directory
+        self.size = size
+        os.makedirs(directory, exist_ok=True)
+
+    def entry(self, circuit: Circuit):
+        """
+        :param circuit:
+        :return: the cache entry of the circuit
+        """
+        return CacheEntry(self, circuit_key(circuit))
+
+    def evict(self, keep: str):
+        """
+        Remove the least recently used entries until the cache fits its size
+        :param keep: key of an entry never to remove
+        :return: void
+        """
+        entries = []
+        total = 0
+        for key in os.listdir(self.directory):
+            path = os.path.join(self.directory, key)
+            if not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+            entries.append((os.path.getmtime(path), key, size))
+            total += size
+
+        for _, key, size in sorted(entries):
+            if total <= self.size:
+                break
+            if key != keep:
+                shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+                total -= size
+
+
+class CacheEntry:
+    """
+    The arrays cached for a single circuit
+    """
+
+    def __init__(self, cache: Cache, key: str):
+        self.cache = cache
+        self.key = key
+        self.path = os.path.join(cache.directory, key)
+
+    def load(self, name: str, mmap_mode=None):
+        """
+        :param name:
+        :param mmap_mode: passed to np.load, to map the array instead of reading it
+        :return: the array, None if it is not cached
+        """
+        try:
+            array = np.load(os.path.join(self.path, name + '.npy'), mmap_mode=mmap_mode)
+        except (FileNotFoundError, ValueError):
+            return None
+        os.utime(self.path)
+        return array
+
+    def save(self, name: str, array: np.ndarray):
+        """
+        Store an array, writing it to a temporary file first so that a concurrent reader never sees it partially
+        :param name:
+        :param array:
+        :return: void
+        """
+        os.makedirs(self.path, exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(descriptor, 'wb') as file:
+            np.save(file, array)
+        os.replace(temporary, os.path.join(self.path, name + '.npy'))
+        os.utime(self.path)
+        self.cache.evict(keep=self.key)
+
+
+def circuit_key(circuit: Circuit):
+    """
+    :param circuit:
+    :return: hash of the structure, the delays and the registers of the circuit
+    """
+    digest = hashlib.sha256()
+    for array in (circuit.component_delay, circuit.src, circuit.dst, circuit.wire_delay):
+        digest.update(np.ascontiguousarray(array, dtype=np.int64).tobytes())
+        digest.update(b'|')
+    return digest.hexdigest()
@@ -0,0 +1,316 @@
+from __future__ import annotations
+
+import copy
+from collections import deque
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+# networkx and scipy are imported by the methods using them, a plain retiming never loads them
+if TYPE_CHECKING:
+    import networkx as nx
+
+# Kinds of edit accepted by Circuit.edit
+COMPONENT_DELAY = 'component_delay'
+WIRE_DELAY = 'wire_delay'
+ADD_EDGE = 'add_edge'
+REMOVE_EDGE = 'remove_edge'
+
+
+class Circuit:
+    """
+    Compact array representation of a circuit.
+    Nodes are the integers 0..n-1 and edges are sorted by source node (CSR), so the out-edges of node v are the
+    indices out_offsets[v]:out_offsets[v + 1]. The in-edges of v are in_edges[in_offsets[v]:in_offsets[v + 1]].
+    """
+
+    def __init__(self, component_delay, src, dst, wire_delay, names=None, name=None):
+        order = np.lexsort((dst, src))
+        self.component_delay = np.asarray(component_delay, dtype=np.int64)
+        self.src = np.asarray(src, dtype=np.int32)[order]
+        self.dst = np.asarray(dst, dtype=np.int32)[order]
+        self.wire_delay = np.asarray(wire_delay, dtype=np.int64)[order]
+        self.names = names
+        # name of the graph it was read from, if any
+        self.name = name
+
+        nodes = len(self.component_delay)
+        self.out_offsets = csr_offsets(self.src, nodes)
+        self.in_edges = np.argsort(self.dst, kind='stable').astype(np.int32)
+        self.in_offsets = csr_offsets(self.dst, nodes)
+
+    def __len__(self):
+        return len(self.component_delay)
+
+    @classmethod
+    def from_graph(cls, graph: nx.DiGraph):
+        """
+        Build the circuit from a graph whose nodes are the integers 0..n-1 and whose delays are already int
+        :param graph:
+        :return: the compact circuit
+        """
+        nodes = range(len(graph))
+        component_delay = [graph.nodes[node]['component_delay'] for node in nodes]
+        names = [graph.nodes[node].get('original-id', node) for node in nodes]
+        edges = list(graph.edges.data('wire_delay'))
+        src = [v1 for (v1, v2, wire_delay) in edges]
+        dst = [v2 for (v1, v2, wire_delay) in edges]
+        wire_delay = [wire_delay for (v1, v2, wire_delay) in edges]
+        return cls(component_delay, src, dst, wire_delay, names, graph.graph.get('name'))
+
+    def to_graph(self) -> nx.DiGraph:
+        """
+        Inverse of from_graph
+        :return: a graph with the integer nodes, their names as 'original-id' and the int delays
+        """
+        import networkx as nx
+
+        graph = nx.DiGraph()
+        names = self.names if self.names is not None else range(len(self))
+        graph.add_nodes_from((node, {'component_delay': delay, 'original-id': name})
+                             for node, (delay, name) in enumerate(zip(self.component_delay.tolist(), names)))
+        graph.add_edges_from((v1, v2, {'wire_delay': wire_delay}) for (v1, v2, wire_delay) in
+                             zip(self.src.tolist(), self.dst.tolist(), self.wire_delay.tolist()))
+        return graph
+
+    def save(self, path: str):
+        """
+        Store the circuit arrays, CSR included, in an uncompressed .npz file
+        :param path:
+        :return: void
+        """
+        names = np.asarray([str(name) for name in self.names]) if self.names is not None else np.empty(0, dtype=str)
+        with open(path, 'wb') as file:
+            np.savez(file, component_delay=self.component_delay, src=self.src, dst=self.dst,
+                     wire_delay=self.wire_delay, out_offsets=self.out_offsets, in_edges=self.in_edges,
+                     in_offsets=self.in_offsets, names=names, has_names=self.names is not None,
+                     name=self.name if self.name is not None else '', has_name=self.name is not None)
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Read a circuit stored by save, without sorting the edges again
+        :param path:
+        :return: the circuit
+        """
+        circuit = cls.__new__(cls)
+        with np.load(path) as data:
+            for field in ('component_delay', 'src', 'dst', 'wire_delay', 'out_offsets', 'in_edges', 'in_offsets'):
+                setattr(circuit, field, data[field])
+            circuit.names = data['names'].tolist() if data['has_names'] else None
+            circuit.name = str(data['name']) if 'has_name' in data.files and data['has_name'] else None
+        return circuit
+
+    def retimed_wire_delay(self, retimings):
+        """
+        :param retimings: lag of each node
+        :return: the wire delay of each edge after applying the retimings: w(e) + r(v) - r(u)
+        """
+        return self.wire_delay + retimings[self.dst] - retimings[self.src]
+
+    def retime(self, retimings):
+        """
+        :param retimings: lag of each node
+        :return: a new circuit, sharing the structure with this one, with the retimings applied
+        """
+        retimed = copy.copy(self)
+        retimed.wire_delay = self.retimed_wire_delay(retimings)
+        return retimed
+
+    def edge_index(self, v1: int, v2: int):
+        """
+        :return: the index of the edge v1 -> v2, None if it does not exist
+        """
+        start, end = int(self.out_offsets[v1]), int(self.out_offsets[v1 + 1])
+        position = start + int(np.searchsorted(self.dst[start:end], v2))
+        if position < end and self.dst[position] == v2:
+            return position
+        return None
+
+    def edit(self, edits):
+        """
+        :param edits: list of tuples, applied in order:
+        - (COMPONENT_DELAY, v, delay)
+        - (WIRE_DELAY, v1, v2, registers)
+        - (ADD_EDGE, v1, v2, registers)
+        - (REMOVE_EDGE, v1, v2)
+        :return: a new circuit with the edits applied
+        """
+        component_delay = np.copy(self.component_delay)
+        wire_delay = np.copy(self.wire_delay)
+        removed = np.zeros(len(wire_delay), dtype=bool)
+        added = {}
+
+        for edit in edits:
+            kind = edit[0]
+            if kind == COMPONENT_DELAY:
+                component_delay[edit[1]] = edit[2]
+                continue
+            if kind not in (WIRE_DELAY, ADD_EDGE, REMOVE_EDGE):
+                raise ValueError("Unknown edit {}".format(kind))
+
+            v1, v2 = edit[1], edit[2]
+            edge = self.edge_index(v1, v2)
+            exists = (v1, v2) in added or (edge is not None and not removed[edge])
+            if kind == ADD_EDGE and exists:
+                raise ValueError("The edge {} -> {} already exists".format(v1, v2))
+            if kind in (WIRE_DELAY, REMOVE_EDGE) and not exists:
+                raise ValueError("The edge {} -> {} does not exist".format(v1, v2))
+
+            if kind == REMOVE_EDGE:
+                if added.pop((v1, v2), None) is None:
+                    removed[edge] = True
+            elif kind == ADD_EDGE or (v1, v2) in added:
+                added[(v1, v2)] = edit[3]
+            else:
+                wire_delay[edge] = edit[3]
+
+        kept = ~removed
+        src = np.concatenate((self.src[kept], np.array([v1 for (v1, v2) in added], dtype=np.int32)))
+        dst = np.concatenate((self.dst[kept], np.array([v2 for (v1, v2) in added], dtype=np.int32)))
+        wire_delay = np.concatenate((wire_delay[kept], np.array(list(added.values()), dtype=np.int64)))
+        return Circuit(component_delay, src, dst, wire_delay, self.names, self.name)
+
+    def edits_to(self, other):
+        """
+        The edits moving this circuit to another one with the same nodes. The removals and the changes adding
+        registers come first, so no intermediate circuit has a cycle without registers that the other one lacks
+        :param other:
+        :return: the list of edits, see edit, None if the nodes of the two circuits differ
+        """
+        if len(other) != len(self) or other.names != self.names:
+            return None
+        nodes = len(self)
+        keys = self.src.astype(np.int64) * nodes + self.dst
+        other_keys = other.src.astype(np.int64) * nodes + other.dst
+        _, edges, other_edges = np.intersect1d(keys, other_keys, assume_unique=True, return_indices=True)
+        changed = self.wire_delay[edges] != other.wire_delay[other_edges]
+        increased = changed & (other.wire_delay[other_edges] > self.wire_delay[edges])
+
+        def edge_edits(kind, indices, circuit, registers=True):
+            return [(kind, v1, v2, delay) if registers else (kind, v1, v2) for v1, v2, delay in
+                    zip(circuit.src[indices].tolist(), circuit.dst[indices].tolist(),
+                        circuit.wire_delay[indices].tolist())]
+
+        removed = np.setdiff1d(np.arange(len(keys)), edges)
+        added = np.setdiff1d(np.arange(len(other_keys)), other_edges)
+        delays = np.nonzero(self.component_delay != other.component_delay)[0]
+        return (edge_edits(REMOVE_EDGE, removed, self, registers=False) +
+                edge_edits(WIRE_DELAY, other_edges[increased], other) +
+                [(COMPONENT_DELAY, node, delay) for node, delay in
+                 zip(delays.tolist(), other.component_delay[delays].tolist())] +
+                edge_edits(WIRE_DELAY, other_edges[changed & ~increased], other) +
+                edge_edits(ADD_EDGE, added, other))
+
+    def reaching(self, nodes):
+        """
+        Backward breadth first search along the in-edges, one level at a time
+        :param nodes:
+        :return: boolean mask of the nodes with a path to any of the given ones, the given ones included
+        """
+        return self._breadth_first_search(nodes, self.in_offsets, self.in_edges, self.src)
+
+    def reachable(self, nodes):
+        """
+        Forward breadth first search along the out-edges, one level at a time
+        :param nodes:
+        :return: boolean mask of the nodes with a path from any of the given ones, the given ones included
+        """
+        return self._breadth_first_search(nodes, self.out_offsets, None, self.dst)
+
+    def _breadth_first_search(self, nodes, offsets: np.ndarray, edges, ends: np.ndarray):
+        """
+        :param offsets: CSR offsets of the edges to follow
+        :param edges: permutation of the edges sorted by the offsets, None if they are already sorted
+        :param ends: the node each edge leads to
+        :return: boolean mask of the nodes visited
+        """
+        mask = np.zeros(len(self), dtype=bool)
+        frontier = np.unique(np.asarray(nodes, dtype=np.int64))
+        mask[frontier] = True
+        while frontier.size > 0:
+            followed = csr_ranges(offsets, frontier)
+            if edges is not None:
+                followed = edges[followed]
+            reached = ends[followed]
+            frontier = np.unique(reached[~mask[reached]])
+            mask[frontier] = True
+        return mask
+
+    def components(self):
+        """
+        :return: the nodes of each weakly connected component, as sorted arrays, largest component first
+        """
+        from scipy.sparse import csr_matrix
+        from scipy.sparse.csgraph import connected_components
+
+        nodes = len(self)
+        adjacency = csr_matrix((np.ones(len(self.src), dtype=np.int8), (self.src, self.dst)), shape=(nodes, nodes))
+        count, labels = connected_components(adjacency, directed=True, connection='weak')
+        order = np.argsort(labels, kind='stable')
+        components = np.split(order, np.cumsum(np.bincount(labels, minlength=count))[:-1])
+        return sorted(components, key=len, reverse=True)
+
+    def subcircuit(self, nodes):
+        """
+        :param nodes: sorted array of nodes, closed under the edges like a component
+        :return: the circuit induced by the nodes, numbered 0..len(nodes)-1 in the same order, with their names
+        """
+        mapping = np.full(len(self), -1, dtype=np.int64)
+        mapping[nodes] = np.arange(len(nodes))
+        kept = mapping[self.src] >= 0
+        names = [self.names[node] for node in nodes.tolist()] if self.names is not None else nodes.tolist()
+        return Circuit(self.component_delay[nodes], mapping[self.src[kept]], mapping[self.dst[kept]],
+                       self.wire_delay[kept], names)
+
+    def topological_order(self, wire_delay=None):
+        """
+        Kahn's algorithm on the edges without registers
+        :param wire_delay: wire delay of each edge, the circuit ones if None
+        :return: the nodes sorted in topological order
+        """
+        if wire_delay is None:
+            wire_delay = self.wire_delay
+        zero = (wire_delay == 0).tolist()
+        dst = self.dst.tolist()
+        out_offsets = self.out_offsets.tolist()
+        in_degree = np.bincount(self.dst[wire_delay == 0], minlength=len(self)).tolist()
+
+        queue = deque(node for node in range(len(self)) if in_degree[node] == 0)
+        order = []
+        while queue:
+            node = queue.popleft()
+            order.append(node)
+            for edge in range(out_offsets[node], out_offsets[node + 1]):
+                if zero[edge]:
+                    target = dst[edge]
+                    in_degree[target] -= 1
+                    if in_degree[target] == 0:
+                        queue.append(target)
+
+        if len(order) != len(self):
+            raise ValueError("The circuit contains a cycle without registers")
+        return order
+
+
+def csr_offsets(keys, nodes: int):
+    """
+    :param keys: the source or target node of each edge
+    :param nodes: number of nodes
+    :return: the CSR offsets array of length nodes + 1
+    """
+    return np.concatenate(([0], np.cumsum(np.bincount(keys, minlength=nodes)))).astype(np.int64)
+
+
+def csr_ranges(offsets: np.ndarray, nodes: np.ndarray):
+    """
+    :param offsets: CSR offsets of the edges sorted by node
+    :param nodes:
+    :return: the indices of all the edges of the given nodes
+    """
+    starts = offsets[nodes]
+    counts = offsets[nodes + 1] - starts
+    ends = np.cumsum(counts)
+    if ends.size == 0 or ends[-1] == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.repeat(starts - (ends - counts), counts) + np.arange(ends[-1])
@@ -0,0 +1,164 @@
+import json
+import time
+import tracemalloc
+from contextlib import nullcontext
+
+# Context manager returned by the phases of a disabled instrument
+_NO_PHASE = nullcontext()
+
+# Phases and events emitted by the retimer
+LOAD = 'load'
+PREPROCESS = 'preprocess'
+WEIGHT_EDGES = 'weight_edges'
+APSP = 'apsp'
+COMPUTE_WD = 'compute_wd'
+SEARCH = 'search'
+MIN_AREA = 'min_area'
+PROBE = 'probe'
+CP = 'cp'
+
+
+class Instrument:
+    """
+    Receiver of the structured events of a retiming. This base class ignores them: subclass it and override
+    phase_started, phase_ended and event to forward them elsewhere.
+    A phase is a timed step, e.g. the all pairs shortest path of WD. An event is a single measure, e.g. a probe of a
+    clock by a checker. The phases are timed and the events whose measure has a cost are emitted only if enabled is
+    set, so the default instrument costs an attribute lookup per phase and an empty call per probe.
+    """
+
+    enabled = False
+
+    def phase(self, name: str, **fields):
+        """
+        :param name:
+        :param fields: values describing the phase, passed to phase_started and phase_ended
+        :return: a context manager timing the phase
+        """
+        if self.enabled is False:
+            return _NO_PHASE
+        return _Phase(self, name, fields)
+
+    def phase_started(self, name: str, fields: dict):
+        pass
+
+    def phase_ended(self, name: str, duration: float, fields: dict):
+        pass
+
+    def event(self, name: str, **fields):
+        pass
+
+
+class Recorder(Instrument):
+    """
+    Instrument keeping all the phases and events, in order of end, as dictionaries with their name under 'event'
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.events = []
+
+    def phase_ended(self, name: str, duration: float, fields: dict):
+        self.events.append(dict(fields, event=name, duration=duration))
+
+    def event(self, name: str, **fields):
+        self.events.append(dict(fields, event=name))
+
+
+class MemoryRecorder(Recorder):
+    """
+    Recorder adding to each phase and probe the memory allocated through tracemalloc, numpy arrays included:
+    - peak_bytes: highest memory in use during the phase or probe, above the memory in use when it started
+    - retained_bytes: memory still in use when it ended, above the memory in use when it started
+    A probe is measured from the previous probe, or from the start of the phase around it. The memory of the
+    processes of the parallel engines and of the memory-mapped files is not traced.
+    Tracing slows down the allocations, so this is meant for diagnosis runs.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._started = not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start()
+        # memory in use at the start of each open phase and the highest one seen since
+        self._frames = []
+        self._mark = tracemalloc.get_traced_memory()[0]
+        self.peak_bytes = 0
+
+    def close(self):
+        """
+        Stop tracing, if it was started by this recorder
+        :return: void
+        """
+        if self._started and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._started = False
+
+    def phase_started(self, name: str, fields: dict):
+        current, _ = self._fold()
+        self._frames.append([current, current])
+        self._mark = current
+
+    def phase_ended(self, name: str, duration: float, fields: dict):
+        current, _ = self._fold()
+        start, peak = self._frames.pop()
+        self._mark = current
+        self.events.append(dict(fields, event=name, duration=duration, peak_bytes=peak - start,
+                                retained_bytes=current - start))
+
+    def event(self, name: str, **fields):
+        if name == PROBE:
+            current, peak = self._fold()
+            fields.update(peak_bytes=peak - self._mark, retained_bytes=current - self._mark)
+            self._mark = current
+        super().event(name, **fields)
+
+    def _fold(self):
+        """
+        Fold the peak since the last call into the open phases, then start a new peak
+        :return: memory in use and peak since the last call, in bytes
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        for frame in self._frames:
+            frame[1] = max(frame[1], peak)
+        self.peak_bytes = max(self.peak_bytes, peak)
+        tracemalloc.reset_peak()
+        return current, peak
+
+    def report(self):
+        """
+        :return: the highest memory in use while recording and the phases and events, in bytes
+        """
+        self._fold()
+        return {'peak_bytes': self.peak_bytes, 'events': self.events}
+
+    def save(self, path: str):
+        """
+        Write the report as JSON
+        :param path:
+        :return: void
+        """
+        with open(path, 'w') as report_file:
+            json.dump(self.report(), report_file, indent=2)
+
+
+class _Phase:
+    """
+    Context manager calling the instrument at the start and at the end of a phase
+    """
+
+    def __init__(self, instrument: Instrument, name: str, fields: dict):
+        self._instrument = instrument
+        self._name = name
+        self._fields = fields
+        self._init = None
+
+    def __enter__(self):
+        self._instrument.phase_started(self._name, self._fields)
+        self._init = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self._instrument.phase_ended(self._name, time.perf_counter() - self._init, self._fields)
+        return False
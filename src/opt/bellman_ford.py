@@ -0,0 +1,124 @@
+import math
+
+import numpy as np
+
+from src.circuit.circuit import csr_offsets, csr_ranges
+
+
+class Arcs:
+    """
+    Arcs sorted by tail with the CSR offsets of the tails, so the arcs leaving a set of nodes are found without
+    scanning them all. Built once for the arcs that do not change between two runs, e.g. the ones of the circuit
+    """
+
+    def __init__(self, nodes: int, tails: np.ndarray, heads: np.ndarray, weights: np.ndarray, offsets=None):
+        """
+        :param nodes: number of nodes
+        :param tails: tail of each arc
+        :param heads: head of each arc
+        :param weights: weight of each arc
+        :param offsets: CSR offsets of the tails if the arcs are already sorted by tail, otherwise they are sorted
+        """
+        if offsets is None:
+            order = np.argsort(tails, kind='stable')
+            tails, heads, weights = tails[order], heads[order], weights[order]
+            offsets = csr_offsets(tails, nodes)
+        self.tails = tails
+        self.heads = heads
+        self.weights = weights
+        self.offsets = offsets
+
+    def leaving(self, nodes: np.ndarray):
+        """
+        :param nodes:
+        :return: the indices of the arcs leaving the given nodes
+        """
+        return csr_ranges(self.offsets, nodes)
+
+
+def bellman_ford(nodes: int, tails: np.ndarray, heads: np.ndarray, weights: np.ndarray, potentials=None, stop=None):
+    """
+    Bellman Ford on arc arrays, see bellman_ford_arcs
+    :param nodes: number of nodes
+    :param tails: tail of each arc
+    :param heads: head of each arc
+    :param weights: weight of each arc
+    :param potentials: starting distances, e.g. the ones of a feasible clock. If None all distances start from 0
+    :param stop: called before each round, if it returns True the search gives up and the feasibility is None
+    :return: if no negative cycle exists, the distances and the number of arc relaxations
+    """
+    return bellman_ford_arcs(nodes, [Arcs(nodes, tails, heads, weights)], potentials, stop)
+
+
+def bellman_ford_arcs(nodes: int, groups: list, potentials=None, stop=None):
+    """
+    Queue-based Bellman Ford from an extra node linked to all the other ones with weight 0.
+    At each round only the arcs leaving the nodes improved by the previous round are relaxed. Every arc relaxation
+    records the parent of its head: a cycle in the parent graph is a negative cycle, so it is looked for
+    periodically (walk to root by pointer jumping) to stop as soon as the constraints are infeasible.
+    The arcs come in groups, each sorted by tail on its own, so a group shared by many runs is never sorted again.
+    :param nodes: number of nodes
+    :param groups: list of Arcs
+    :param potentials: starting distances, e.g. the ones of a feasible clock. If None all distances start from 0
+    :param stop: called before each round, if it returns True the search gives up and the feasibility is None
+    :return: if no negative cycle exists, the distances and the number of arc relaxations
+    """
+    parent = np.full(nodes, -1, dtype=np.int64)
+    if potentials is None:
+        distances = np.zeros(nodes, dtype=np.int64)
+        queue = np.arange(nodes)
+    else:
+        distances = np.array(potentials, dtype=np.int64)
+        queue = np.unique(np.concatenate(
+            [group.tails[distances[group.tails] + group.weights < distances[group.heads]] for group in groups]))
+
+    # checking the parent graph costs O(V log V), so do it once every log V rounds
+    check_period = max(1, int(math.log2(nodes + 1)))
+    relaxations = 0
+    rounds = 0
+
+    while queue.size > 0:
+        if stop is not None and stop():
+            return None, None, relaxations
+        rounds += 1
+        if rounds > nodes:
+            return False, None, relaxations
+
+        tails, heads, candidates = [], [], []
+        for group in groups:
+            arcs = group.leaving(queue)
+            group_candidates = distances[group.tails[arcs]] + group.weights[arcs]
+            improving = group_candidates < distances[group.heads[arcs]]
+            arcs = arcs[improving]
+            tails.append(group.tails[arcs])
+            heads.append(group.heads[arcs])
+            candidates.append(group_candidates[improving])
+        tails, heads, candidates = np.concatenate(tails), np.concatenate(heads), np.concatenate(candidates)
+        relaxations += candidates.size
+
+        relaxed = np.copy(distances)
+        np.minimum.at(relaxed, heads, candidates)
+        best = candidates == relaxed[heads]
+        parent[heads[best]] = tails[best]
+
+        queue = np.nonzero(relaxed < distances)[0]
+        distances = relaxed
+
+        if rounds % check_period == 0 and _has_cycle(parent):
+            return False, None, relaxations
+
+    return True, distances, relaxations
+
+
+def _has_cycle(parent: np.ndarray):
+    """
+    Walk to the root from every node at once by pointer jumping: after |V| steps only the nodes of a cycle
+    (or leading to a cycle) have not reached a root.
+    :param parent: parent of each node, -1 for the roots
+    :return: if the parent graph contains a cycle
+    """
+    nodes = len(parent)
+    jump = np.append(np.where(parent < 0, nodes, parent), nodes)
+    for _ in range(int(math.log2(nodes + 1)) + 1):
+        jump = jump[jump]
+    return bool(np.any(jump[:nodes] != nodes))
@@ -0,0 +1,89 @@
+import numpy as np
+
+from src.circuit.circuit import csr_offsets
+from src.opt.bellman_ford import Arcs
+from src.wd.wd import SparseWD, row_tiles
+
+
+class ConstraintSet:
+    """
+    Second type constraints of OPT1, r(u) - r(v) <= W(u,v) - 1 for every pair with D(u,v) > floor, sorted by D.
+    The constraints of a clock c are the ones with D(u,v) > c, a suffix of the set: moving from a clock to another
+    only adds or removes the constraints whose D lies between the two clocks.
+    """
+
+    def __init__(self, sources, targets, weights, delays, floor: int):
+        order = np.argsort(delays, kind='stable')
+        self.sources = np.asarray(sources, dtype=np.int32)[order]
+        self.targets = np.asarray(targets, dtype=np.int32)[order]
+        self.weights = np.asarray(weights, dtype=np.int64)[order]
+        self.delays = np.asarray(delays)[order]
+        self.floor = floor
+        self.clock = None
+        self._start = len(self.delays)
+        # the constraints sorted by target, i.e. by the tail of their arc, built by the first arcs call
+        self._by_target = None
+
+    def __len__(self):
+        return len(self.delays)
+
+    @classmethod
+    def from_matrices(cls, w: np.ndarray, d: np.ndarray, floor: int):
+        """
+        Collect the constraints from the W and D matrices, one tile of rows at a time
+        :param w:
+        :param d:
+        :param floor: only the pairs with D(u,v) > floor are kept
+        :return: the constraint set
+        """
+        sources, targets, weights, delays = [], [], [], []
+        for start, d_tile in row_tiles(d):
+            rows, columns = np.nonzero(d_tile > floor)
+            w_tile = w[start:start + len(d_tile)]
+            sources.append(rows + start)
+            targets.append(columns)
+            weights.append(w_tile[rows, columns].astype(np.int64) - 1)
+            delays.append(d_tile[rows, columns])
+        return cls(np.concatenate(sources), np.concatenate(targets), np.concatenate(weights),
+                   np.concatenate(delays), floor)
+
+    @classmethod
+    def from_pairs(cls, pairs: SparseWD):
+        """
+        Collect the constraints from the pairs computed by the sparse WD, already sorted by D
+        :param pairs:
+        :return: the constraint set
+        """
+        return cls(pairs.sources, pairs.targets, pairs.w - 1, pairs.d, pairs.floor)
+
+    def update(self, clock: int):
+        """
+        Move to the constraints of a new clock
+        :param clock:
+        :return: the number of constraints added (positive) or removed (negative) with respect to the previous clock
+        """
+        start = int(np.searchsorted(self.delays, clock, side='right'))
+        changed = self._start - start
+        self._start = start
+        self.clock = clock
+        return changed
+
+    def active(self):
+        """
+        :return: sources, targets and weights of the constraints of the current clock, as views of the set
+        """
+        start = self._start
+        return self.sources[start:], self.targets[start:], self.weights[start:]
+
+    def arcs(self, nodes: int):
+        """
+        The constraints are sorted by target once, the ones of each clock are then picked in that order without
+        sorting them again
+        :param nodes: number of nodes of the circuit
+        :return: the arcs v -> u of weight W(u,v) - 1 of the constraints of the current clock, sorted by tail
+        """
+        if self._by_target is None:
+            self._by_target = np.argsort(self.targets, kind='stable')
+        order = self._by_target[self._by_target >= self._start]
+        tails = self.targets[order]
+        return Arcs(nodes, tails, self.sources[order], self.weights[order], csr_offsets(tails, nodes))
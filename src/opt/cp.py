@@ -0,0 +1,75 @@
+import numpy as np
+
+from src.circuit.circuit import Circuit, csr_offsets, csr_ranges
+
+
+def clock_period(circuit: Circuit, wire_delay: np.ndarray):
+    """
+    CP algorithm as a Kahn level sweep on the edges without registers: each level holds the nodes whose
+    predecessors have all been processed, so delta_v(v) = d(v) + max(delta_v(u)) for all the arcs u -> v with
+    w(e) = 0 is computed for a whole level at once. Every edge and node is touched once: O(V + E) time and memory.
+    :param circuit:
+    :param wire_delay: the wire delay of each circuit edge
+    :return: the clock period and the delta_v of all nodes
+    """
+    # Pick only the edges with w(e) = 0, they keep the circuit order so they are still sorted by source
+    no_registers = np.nonzero(wire_delay == 0)[0]
+    nodes_delay = _level_sweep(circuit.component_delay, circuit.src[no_registers], circuit.dst[no_registers])
+    return np.max(nodes_delay), nodes_delay
+
+
+def clock_periods(circuit: Circuit, wire_delays: np.ndarray):
+    """
+    CP algorithm on many retimings of the same circuit at once. The copies of the circuit are handled as the
+    disjoint components of a single graph, so a single level sweep serves all of them.
+    :param circuit:
+    :param wire_delays: matrix with the wire delay of each circuit edge, one row per retiming
+    :return: the clock period of each row and the matrix of the delta_v of all nodes
+    """
+    nodes = len(circuit)
+    rows = wire_delays.shape[0]
+
+    # row-major order: edges sorted by row and then by source, so by source in the joint graph
+    row, no_registers = np.nonzero(wire_delays == 0)
+    src = row * nodes + circuit.src[no_registers]
+    dst = row * nodes + circuit.dst[no_registers]
+
+    nodes_delay = _level_sweep(np.tile(circuit.component_delay, rows), src, dst).reshape(rows, nodes)
+    return np.max(nodes_delay, axis=1), nodes_delay
+
+
+def _level_sweep(component_delay: np.ndarray, src: np.ndarray, dst: np.ndarray):
+    """
+    :param component_delay: delay of each node
+    :param src: source of each edge without registers, sorted
+    :param dst: target of each edge without registers
+    :return: the delta_v of all nodes
+    """
+    nodes = len(component_delay)
+    offsets = csr_offsets(src, nodes)
+    in_degree = np.bincount(dst, minlength=nodes)
+
+    nodes_delay = np.copy(component_delay)
+    arrival = np.zeros(nodes, dtype=nodes_delay.dtype)
+    position = np.zeros(nodes, dtype=np.int64)
+    level = np.nonzero(in_degree == 0)[0]
+    processed = 0
+
+    while level.size > 0:
+        processed += level.size
+        nodes_delay[level] += arrival[level]
+
+        edges = csr_ranges(offsets, level)
+        targets = dst[edges]
+        np.maximum.at(arrival, targets, nodes_delay[src[edges]])
+        np.subtract.at(in_degree, targets, 1)
+
+        # next level: targets without unprocessed predecessors, each one taken once
+        ready = targets[in_degree[targets] == 0]
+        position[ready] = np.arange(ready.size)
+        level = ready[position[ready] == np.arange(ready.size)]
+
+    if processed != nodes:
+        raise ValueError("The circuit contains a cycle without registers")
+
+    return nodes_delay
@@ -0,0 +1,69 @@
+import numpy as np
+
+from src.circuit.circuit import Circuit
+from src.opt.cp import clock_periods
+
+# Upper bound on the number of elements of the (clocks x edges) matrices of a batch
+_BATCH_ELEMENTS = 1 << 22
+
+
+def batched_feas(circuit: Circuit, clocks, retimings=None):
+    """
+    FEAS algorithm on many clocks at once. The lags are kept in a (clocks x nodes) matrix and at each iteration CP
+    runs on all the retimed circuits together, then the lags of the nodes with delta_v(v) > c are incremented
+    row by row. A row stops as soon as its clock is met. The clocks are split in batches to bound the memory.
+    :param circuit:
+    :param clocks: the clocks to check
+    :param retimings: starting lags, one row per clock. If None all the lags start from 0
+    :return: if each clock is feasible and the matrix of the retimings found
+    """
+    clocks = np.asarray(clocks)
+    nodes = len(circuit)
+    if retimings is None:
+        retimings = np.zeros((clocks.size, nodes), dtype=int)
+    else:
+        retimings = np.array(retimings, dtype=int)
+    feasible = np.zeros(clocks.size, dtype=bool)
+
+    batch = max(1, _BATCH_ELEMENTS // max(1, len(circuit.src), nodes))
+    for start in range(0, clocks.size, batch):
+        rows = slice(start, start + batch)
+        feasible[rows] = _feas_batch(circuit, clocks[rows], retimings[rows])
+
+    return feasible, retimings
+
+
+def _feas_batch(circuit: Circuit, clocks: np.ndarray, retimings: np.ndarray):
+    """
+    :param circuit:
+    :param clocks: the clocks of the batch
+    :param retimings: lags of the batch, updated in place
+    :return: if each clock is feasible
+    """
+    feasible = np.zeros(clocks.size, dtype=bool)
+    active = np.arange(clocks.size)
+
+    for _ in range(len(circuit) - 1):
+        if active.size == 0:
+            break
+        periods, delta_vs = clock_periods(circuit, _retimed_wire_delays(circuit, retimings[active]))
+
+        # the rows whose clock is met are done, the other ones increment the lag of 1 <=> delta_v(v) > clock
+        met = periods <= clocks[active]
+        feasible[active[met]] = True
+        active = active[~met]
+        retimings[active] += delta_vs[~met] > clocks[active, None]
+    else:
+        if active.size > 0:
+            periods, _ = clock_periods(circuit, _retimed_wire_delays(circuit, retimings[active]))
+            feasible[active] = periods <= clocks[active]
+
+    return feasible
+
+
+def _retimed_wire_delays(circuit: Circuit, retimings: np.ndarray):
+    """
+    :param retimings: lags, one row per retiming
+    :return: the wire delay of each edge, one row per retiming
+    """
+    return circuit.wire_delay + retimings[:, circuit.dst] - retimings[:, circuit.src]
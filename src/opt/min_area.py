@@ -0,0 +1,119 @@
+import numpy as np
+
+from src.circuit.circuit import Circuit, csr_ranges
+from src.opt.bellman_ford import bellman_ford
+from src.opt.constraints import ConstraintSet
+
+# constraints checked at once by the pruning, bounds the memory of the gathered in-edges
+_PRUNE_ELEMENTS = 1 << 22
+
+
+def registers(circuit: Circuit, retimings=None):
+    """
+    :param circuit:
+    :param retimings: lag of each node, None for the circuit as it is
+    :return: the total number of registers on the edges
+    """
+    if retimings is None:
+        return int(np.sum(circuit.wire_delay))
+    return int(np.sum(circuit.retimed_wire_delay(np.asarray(retimings))))
+
+
+def min_area_retiming(circuit: Circuit, constraints: ConstraintSet, clock: int):
+    """
+    Among the legal retimings of a feasible clock find one with the fewest registers.
+    The registers after a retiming are sum(w(e)) + sum_v r(v) * (indegree(v) - outdegree(v)), so the problem is the
+    LP minimizing sum_v r(v) * (indegree(v) - outdegree(v)) subject to the difference constraints of OPT1:
+    r(u) - r(v) <= w(e) for each edge u -> v and r(u) - r(v) <= W(u,v) - 1 for each pair with D(u,v) > clock.
+    Its dual is a min-cost flow on the constraint graph, an arc u -> v of cost b for each r(u) - r(v) <= b and a
+    demand of indegree(v) - outdegree(v) on each node, solved by network simplex. The lags are then the potentials
+    of the optimal flow: a solution of the constraints that is tight on every arc carrying flow.
+    :param circuit:
+    :param constraints: the constraint set of the circuit
+    :param clock: a clock with a legal retiming
+    :return: the lags with the fewest registers, None if the clock has no legal retiming
+    """
+    import networkx as nx
+
+    nodes = len(circuit)
+    constraints.update(clock)
+    sources, targets, weights = _prune(circuit, *constraints.active())
+
+    tails = np.concatenate((circuit.src, sources)).astype(np.int64)
+    heads = np.concatenate((circuit.dst, targets)).astype(np.int64)
+    costs = np.concatenate((circuit.wire_delay, weights))
+    kept = tails != heads
+    tails, heads, costs = _cheapest_arcs(nodes, tails[kept], heads[kept], costs[kept])
+
+    flow_graph = nx.DiGraph()
+    demand = np.bincount(circuit.dst, minlength=nodes) - np.bincount(circuit.src, minlength=nodes)
+    flow_graph.add_nodes_from((node, {'demand': node_demand}) for node, node_demand in enumerate(demand.tolist()))
+    flow_graph.add_weighted_edges_from(zip(tails.tolist(), heads.tolist(), costs.tolist()), weight='cost')
+    try:
+        _, flow = nx.network_simplex(flow_graph, weight='cost')
+    except nx.NetworkXUnbounded:
+        # a cycle of negative cost is a cycle of constraints that cannot be met
+        return None
+
+    # the potentials meet every constraint, r(u) <= r(v) + b as an arc v -> u of cost b for Bellman Ford, and are
+    # tight on the arcs carrying flow, r(v) <= r(u) - b as an arc u -> v of cost -b
+    used = np.array([flow[tail][head] > 0 for tail, head in zip(tails.tolist(), heads.tolist())], dtype=bool)
+    feasible, retimings, _ = bellman_ford(nodes, np.concatenate((heads, tails[used])),
+                                          np.concatenate((tails, heads[used])),
+                                          np.concatenate((costs, -costs[used])))
+    if feasible is False:
+        return None
+    return retimings
+
+
+def _prune(circuit: Circuit, sources: np.ndarray, targets: np.ndarray, weights: np.ndarray):
+    """
+    Drop the constraints implied by another one and an edge. If v' -> v is an edge, D(u,v') > clock and
+    W(u,v') + w(v',v) = W(u,v), then r(u) - r(v') <= W(u,v') - 1 and r(v') - r(v) <= w(v',v) already give
+    r(u) - r(v) <= W(u,v) - 1. The implying constraint is kept or implied in turn by a pair with a smaller W, or with
+    the same W and a target earlier in the order of the edges without registers, so the pruned set is equivalent.
+    :param circuit:
+    :param sources: sources u of the constraints
+    :param targets: targets v of the constraints
+    :param weights: W(u,v) - 1 of the constraints
+    :return: sources, targets and weights of the constraints kept
+    """
+    nodes = len(circuit)
+    keys = sources.astype(np.int64) * nodes + targets
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    sorted_weights = weights[order]
+    in_degree = np.diff(circuit.in_offsets)
+
+    redundant = np.zeros(len(keys), dtype=bool)
+    counts = in_degree[targets]
+    gathered = np.concatenate(([0], np.cumsum(counts)))
+    start = 0
+    while start < len(keys):
+        # the largest block of constraints whose in-edges fit in the budget, at least one
+        end = int(np.searchsorted(gathered, gathered[start] + _PRUNE_ELEMENTS, side='right')) - 1
+        end = max(start + 1, min(end, len(keys)))
+        block = np.arange(start, end)
+        edges = circuit.in_edges[csr_ranges(circuit.in_offsets, targets[block])]
+        constraint = np.repeat(block, counts[block])
+
+        implying = sources[constraint].astype(np.int64) * nodes + circuit.src[edges]
+        position = np.minimum(np.searchsorted(sorted_keys, implying), len(sorted_keys) - 1)
+        implied = ((sorted_keys[position] == implying) &
+                   (sorted_weights[position] + circuit.wire_delay[edges] == weights[constraint]))
+        redundant[constraint[implied]] = True
+        start = end
+
+    kept = ~redundant
+    return sources[kept], targets[kept], weights[kept]
+
+
+def _cheapest_arcs(nodes: int, tails: np.ndarray, heads: np.ndarray, costs: np.ndarray):
+    """
+    :return: a single arc, the cheapest one, for each pair of nodes
+    """
+    keys = tails * nodes + heads
+    order = np.lexsort((costs, keys))
+    keys = keys[order]
+    first = np.concatenate(([True], keys[1:] != keys[:-1]))
+    return tails[order][first], heads[order][first], costs[order][first]
@@ -1,8 +1,19 @@
-import itertools
+import bisect
 import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+from multiprocessing.sharedctypes import RawArray
 
 import numpy as np
-import networkx as nx
+
+from src.circuit.circuit import Circuit
+from src.instrument.instrument import CP, MIN_AREA, PROBE, SEARCH, Instrument
+from src.opt.bellman_ford import Arcs, bellman_ford_arcs
+from src.opt.constraints import ConstraintSet
+from src.opt.cp import clock_period
+from src.opt.feas import batched_feas
+from src.opt.min_area import min_area_retiming, registers
+from src.wd.wd import row_tiles
 
 
 class OPT:
@@ -10,66 +21,214 @@ class OPT:
     Class responsible of executing the OPT1 algorithm on a graph
     """
 
-    def __init__(self, graph: nx.DiGraph, w: np.core.ndarray, d: np.core.ndarray):
-        self.node_delay = None
-        self.graph = graph
-        self.retimed_graph = nx.DiGraph(graph)
+    def __init__(self, circuit: Circuit, w: np.core.ndarray, d: np.core.ndarray):
+        self.circuit = circuit
+        self.retimed_circuit = None
         self.w = w
         self.d = d
+        # pairs computed by the sparse WD, used in place of W and D when set
+        self.pairs = None
         self.min_clock = 0
         self._d_range = []
         self.retimings = {}
         self._checker = None
-        self._wire_delay = 'wire_delay'
-        self._component_delay = 'component_delay'
-        self._lag = 'lag'
-
-    def opt(self, optimizer: str):
+        self._constraints = None
+        # arcs of the circuit sorted by tail, built by the first Bellman Ford check
+        self._circuit_arcs = None
+        # when set the checkers start from the solution of the nearest feasible clock already found
+        self.warm_start = False
+        self._feasible_retimings = {}
+        # number of clocks probed at once by the speculative search, 1 for the binary search
+        self.search_jobs = 1
+        # when set opt2 checks all the candidate clocks at once with the batched FEAS
+        self.batched = False
+        # when set opt2 searches the integer clocks between the slowest component and the clock of the circuit,
+        # so W and D are never needed
+        self.matrix_free = False
+        self._optimizer = None
+        # entry of the persistent cache of the circuit, if any, with the results of the clocks already checked
+        self.cache = None
+        self._uncached_checker = None
+        self._cached_results = {}
+        self._infeasible_clocks = set()
+        self._stored = (0, 0)
+        # clock and retimings the search starts from after the circuit was edited
+        self._start_clock = None
+        self._seed = None
+        # registers of the retimings found by the search and of the minimum area ones, set by min_area
+        self.registers = None
+        # lowest and highest clock still relevant to the speculative search, shared with its workers: the checkers
+        # give up, returning None as feasibility, as soon as their clock falls outside
+        self._bounds = None
+        # receives the search phase, the probes of the checkers and the CP calls. The probes of the speculative
+        # search run in other processes and are not reported
+        self.instrument = Instrument()
+
+    def opt(self, optimizer: str, start=None):
         """
         Optimize the graph choosing between opt1 and opt2 algorithm.
         Print also the total execution time
         :param optimizer: the algorithm to use
+        :param start: the minimum clock and the retimings found before the circuit was edited, if any. The search
+        starts from that clock and, if they are still legal, the checks start from those retimings
         :return: void
         """
 
-        self._d_range = self._create_d_range()
-
-        if optimizer is "opt1":
-            self._checker = self._bellman_ford_checker
-        else:
-            self._checker = self._feas_checker
+        self._start_clock, self._seed = None, None
+        if start is not None:
+            self._start_clock = start[0]
+            if start[1] is not None and np.all(self.circuit.retimed_wire_delay(np.asarray(start[1])) >= 0):
+                self._seed = np.asarray(start[1])
+        self._select_checker(optimizer)
+        self._d_range = self._create_period_range() if self.matrix_free is True else self._create_d_range()
+        self._constraints = None
+        self._circuit_arcs = None
+        self._feasible_retimings = {}
+        self.registers = None
+        self._load_results()
 
         init = time.time()
-        self.search_min_clock()
+        with self.instrument.phase(SEARCH, optimizer=optimizer, nodes=len(self.circuit), clocks=len(self._d_range)):
+            self.search_min_clock()
         end = time.time()
+        self._save_results()
+        self._start_clock, self._seed = None, None
         print("{} algorithm {}".format(optimizer, end - init))
 
         print("minimum clock cycle: {}".format(self.min_clock))
 
+    def _select_checker(self, optimizer: str):
+        """
+        :param optimizer: "opt1" uses Bellman Ford, any other value FEAS
+        :return: void
+        """
+        self._optimizer = optimizer
+        if optimizer == "opt1" and self.batched is True:
+            raise ValueError("The batched search is only available for opt2")
+        if optimizer == "opt1" and self.matrix_free is True:
+            raise ValueError("opt1 needs the W and D matrices")
+        if self.batched is True and self.matrix_free is True:
+            raise ValueError("The batched search checks the D values, it needs the W and D matrices")
+        if optimizer == "opt1":
+            self._checker = self._bellman_ford_checker
+        else:
+            self._checker = self._feas_checker
+        if self.cache is not None:
+            self._uncached_checker = self._checker
+            self._checker = self._cached_checker
+
     def _create_d_range(self):
         """
-        Sort D values, and delete the duplicates
+        Sort D values, and delete the duplicates. D is read one tile of rows at a time
         :return: void
         """
+        if self.pairs is not None:
+            return self.pairs.clocks()
+        if self.cache is not None:
+            d_range = self.cache.load('d_range')
+            if d_range is not None:
+                return d_range
+
+        d_range = np.empty(0, dtype=self.d.dtype)
+        for _, tile in row_tiles(self.d):
+            d_range = np.union1d(d_range, tile)
+
+        if self.cache is not None:
+            self.cache.save('d_range', d_range)
+        return d_range
+
+    def _results_name(self):
+        """
+        :return: the name of the cached results of the current checker, warm start changes the retimings found
+        """
+        return self._optimizer + ('-warm' if self.warm_start is True or self._seed is not None else '')
+
+    def _load_results(self):
+        """
+        Read from the cache the retimings of the clocks found feasible by the current checker and the clocks found
+        infeasible by any checker
+        :return: void
+        """
+        self._cached_results = {}
+        self._infeasible_clocks = set()
+        if self.cache is None:
+            return
+
+        clocks = self.cache.load(self._results_name() + '-clocks')
+        retimings = self.cache.load(self._results_name() + '-retimings')
+        if clocks is not None and retimings is not None:
+            self._cached_results = dict(zip(clocks.tolist(), retimings))
+        infeasible = self.cache.load('infeasible')
+        if infeasible is not None:
+            self._infeasible_clocks = set(infeasible.tolist())
+        self._stored = (len(self._cached_results), len(self._infeasible_clocks))
+
+    def _save_results(self):
+        """
+        Store in the cache the results of the clocks checked, if any new one was found
+        :return: void
+        """
+        if self.cache is None:
+            return
+
+        results = dict(self._cached_results)
+        results.update(self._feasible_retimings)
+        if len(results) > self._stored[0]:
+            clocks = sorted(results)
+            self.cache.save(self._results_name() + '-clocks', np.array(clocks))
+            self.cache.save(self._results_name() + '-retimings', np.array([results[clock] for clock in clocks]))
+        if len(self._infeasible_clocks) > self._stored[1]:
+            self.cache.save('infeasible', np.array(sorted(self._infeasible_clocks)))
+
+    def _cached_checker(self, clock: int):
+        """
+        Look up the clock among the results cached before running the checker
+        :param clock:
+        :return: If the retiming is legal and the retiming to apply
+        """
+        if clock in self._cached_results:
+            return True, self._cached_results[clock]
+        if clock in self._infeasible_clocks:
+            return False, None
+
+        feasible, retimings = self._uncached_checker(clock)
+        if feasible is False:
+            self._infeasible_clocks.add(clock)
+        return feasible, retimings
 
-        return np.sort(np.unique(self.d.ravel()))
+    def _create_period_range(self):
+        """
+        The minimum clock lies between the delay of the slowest component and the clock of the circuit as it is
+        :return: all the integer clocks in that interval, as a range so that its size does not depend on the delays
+        """
+        clock, _ = self._clock_period(self.circuit.wire_delay)
+        return range(int(np.max(self.circuit.component_delay)), int(clock) + 1)
 
     def search_min_clock(self):
         """
         Search the minimum clock cycle with a legal retiming
         :return: void
         """
-        # keeps track of the clock already checked with the corresponding retimings
-        clocks_explored = [(clock_candidate, None, None) for clock_candidate in self._d_range]
+        if self._start_clock is not None:
+            feasible, self.retimings = self._search_from(self._start_clock)
+        elif self.batched is True:
+            feasible, self.retimings = self._batched_search()
+        elif self.search_jobs > 1:
+            feasible, self.retimings = self._speculative_search(self.search_jobs)
+        elif self.matrix_free is True:
+            feasible, self.retimings = self._period_search()
+        else:
+            # keeps track of the clock already checked with the corresponding retimings
+            clocks_explored = [(clock_candidate, None, None) for clock_candidate in self._d_range]
 
-        # Execute the binary search
-        feasible, self.retimings = self._binary_search_recursive(clocks_explored, 0,
-                                                                 len(clocks_explored) - 1)
-        # Apply the legal retiming found to the graph
-        self._apply_retiming(self.graph, self.retimings)
+            # Execute the binary search
+            feasible, self.retimings = self._binary_search_recursive(clocks_explored, 0,
+                                                                     len(clocks_explored) - 1)
+        # Apply the legal retiming found to the circuit
+        self.retimed_circuit = self.circuit.retime(self.retimings)
 
         # Compute the minimum clock cycle
-        self.min_clock, _ = self._clock_period(self.graph)
+        self.min_clock, _ = self._clock_period(self.retimed_circuit.wire_delay)
 
     def _binary_search_recursive(self, clocks, start, end):
         """
@@ -87,11 +246,11 @@ class OPT:
         clocks[mid] = (clocks[mid][0], feasible, retimings)
 
         # exit positively if the possible retiming is the minimum one
-        if mid is 0 and feasible is True:
+        if mid == 0 and feasible is True:
             return feasible, retimings
 
         # if the highest possible clock is not feasible return false
-        if mid is len(clocks) - 1 and feasible is False:
+        if mid == len(clocks) - 1 and feasible is False:
             return feasible, None
 
         # Explore the predecessor
@@ -107,119 +266,396 @@ class OPT:
         else:
             return self._binary_search_recursive(clocks, mid + 1, end)
 
+    def _search_from(self, clock: int):
+        """
+        Galloping search around a clock expected to be close to the minimum one: move away from it doubling the step
+        until the minimum is enclosed, then bisect. When the minimum did not move only a couple of checks are needed.
+        :param clock:
+        :return: if a clock feasible exists returns the retimings to apply otherwise None
+        """
+        clocks = self._d_range
+        low, high = 0, len(clocks) - 1
+        best = None
+        index = min(bisect.bisect_left(clocks, clock), high)
+
+        feasible, retimings = self._checker(clocks[index])
+        if feasible is True:
+            best, high = retimings, index - 1
+        else:
+            low = index + 1
+
+        # towards lower clocks until an infeasible one, or towards higher clocks until a feasible one
+        direction = -1 if feasible is True else 1
+        step = 1
+        while low <= high:
+            probe = index + direction * step
+            if not low <= probe <= high:
+                break
+            feasible, retimings = self._checker(clocks[probe])
+            if feasible is True:
+                best, high = retimings, probe - 1
+            else:
+                low = probe + 1
+            if feasible == (direction > 0):
+                break
+            index, step = probe, step * 2
+
+        while low <= high:
+            mid = (low + high) // 2
+            feasible, retimings = self._checker(clocks[mid])
+            if feasible is True:
+                best, high = retimings, mid - 1
+            else:
+                low = mid + 1
+
+        return best is not None, best
+
+    def _period_search(self):
+        """
+        Bisection on the integer clocks between the two bounds of the period range: the highest one is always
+        feasible since it is the clock of the circuit as it is
+        :return: if a clock feasible exists returns the retimings to apply otherwise None
+        """
+        low, high = self._d_range.start, self._d_range.stop - 1
+        retimings = None
+        while low < high:
+            mid = (low + high) // 2
+            feasible, mid_retimings = self._checker(mid)
+            if feasible is True:
+                high, retimings = mid, mid_retimings
+            else:
+                low = mid + 1
+
+        if retimings is None:
+            _, retimings = self._checker(high)
+        return True, retimings
+
+    def _speculative_search(self, jobs: int):
+        """
+        k-ary search: at each round k clocks evenly spaced in the interval still to explore are checked at once by a
+        pool of processes, so the interval shrinks by a factor k + 1. Every result shrinks the interval immediately
+        and the probes left outside of it are cancelled. The running ones see the interval through shared memory and
+        give up at the next FEAS iteration or Bellman Ford round, so they free their worker for the next round.
+        The workers share W and D through shared memory, or through the files in out-of-core mode.
+        :param jobs: number of processes, i.e. clocks checked at each round
+        :return: if a clock feasible exists returns the retimings to apply otherwise None
+        """
+        clocks = self._d_range
+        low, high = 0, len(clocks) - 1
+        best, best_retimings = None, None
+
+        matrices, handles = [], []
+        if self._optimizer == "opt1" and self.pairs is None:
+            for matrix in (self.w, self.d):
+                reference, handle = _share(matrix)
+                matrices.append(reference)
+                handles.append(handle)
+
+        bounds = RawArray('q', [int(clocks[low]), int(clocks[high])])
+        pool = ProcessPoolExecutor(max_workers=jobs, initializer=_init_probe_worker,
+                                   initargs=(self.circuit, self._optimizer, matrices, self.pairs, bounds))
+        try:
+            while low <= high:
+                span = high - low + 1
+                indices = sorted({low + (span * (i + 1)) // (jobs + 1) for i in range(jobs)}) \
+                    if span > jobs else range(low, high + 1)
+                probes = {pool.submit(_probe, clocks[index]): index for index in indices}
+
+                pending = set(probes)
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for probe in done:
+                        if probe.cancelled():
+                            continue
+                        index = probes[probe]
+                        feasible, retimings = probe.result()
+                        if feasible is True:
+                            self._feasible_retimings[clocks[index]] = retimings
+                            if best is None or index < best:
+                                best, best_retimings = index, retimings
+                            high = min(high, index - 1)
+                        elif feasible is False:
+                            low = max(low, index + 1)
+
+                    # stop the probes that can no more change the result. The interval only shrinks, so writing the
+                    # low bound first never stops a probe still needed
+                    if low <= high:
+                        bounds[0], bounds[1] = int(clocks[low]), int(clocks[high])
+                    else:
+                        bounds[0], bounds[1] = 1, 0
+                    irrelevant = {probe for probe in pending if not low <= probes[probe] <= high}
+                    for probe in irrelevant:
+                        probe.cancel()
+                    pending -= irrelevant
+        finally:
+            bounds[0], bounds[1] = 1, 0
+            pool.shutdown(wait=False, cancel_futures=True)
+            for handle in handles:
+                if handle is not None:
+                    handle.close()
+                    handle.unlink()
+
+        if best is None:
+            return False, None
+        return True, best_retimings
+
+    def _batched_search(self):
+        """
+        Check all the candidate clocks with a single batched FEAS and pick the smallest feasible one
+        :return: if a clock feasible exists returns the retimings to apply otherwise None
+        """
+        feasible_clocks = self.feasible_clocks()
+        if not feasible_clocks:
+            return False, None
+        return True, feasible_clocks[min(feasible_clocks)]
+
+    def feasible_clocks(self, clocks=None):
+        """
+        Run FEAS on many clocks in one vectorized pass
+        :param clocks: the clocks to check, all the D values if None
+        :return: a dictionary with the retimings of each feasible clock
+        """
+        if clocks is None:
+            clocks = self._d_range
+        # no retiming can make the clock shorter than the slowest component
+        clocks = np.asarray(clocks)
+        clocks = clocks[clocks >= np.max(self.circuit.component_delay)]
+
+        feasible, retimings = batched_feas(self.circuit, clocks)
+        feasible_clocks = {clock: retimings[row] for row, clock in enumerate(clocks.tolist()) if feasible[row]}
+        self._feasible_retimings.update(feasible_clocks)
+        return feasible_clocks
+
     def _bellman_ford_checker(self, clock: int):
         """
         Check if a legal retiming exists given a clock duration using Bellman Ford algorithm
         :param clock:
         :return: If the retiming is legal and the retiming to apply
         """
-        feasibility_graph = nx.DiGraph()
-        feasibility_graph.add_nodes_from(self.graph.nodes)
-
-        # add first type of constraint from the original graph -> r(u) - r(v) <= w(e), so create arc v -> u
-        feasibility_graph.add_weighted_edges_from([(target, source, weight[self._wire_delay])
-                                                   for (source, target, weight) in self.graph.edges.data()])
-
-        # add second type of constraint from the original graph: r(u) - r(v) <= W(u,v) - 1 if D(u,v) > c
-        feasibility_graph.add_weighted_edges_from([(target, source, self.w[int(source)][int(target)] - 1)
-                                                   for (source, target) in
-                                                   #Do the nodes cartesian product
-                                                   list(itertools.product(feasibility_graph.nodes, feasibility_graph.nodes))
-                                                   if self.d[int(source)][int(target)] > clock])
-        # add extra node for Bellman Ford
-        extra_node = 'extra_node'
-        feasibility_graph.add_node(extra_node)
-        # add extra edges from the extra node to all the other ones
-        feasibility_graph.add_weighted_edges_from([(extra_node, node, 0)
-                                                   for node in self.graph.nodes])
+        circuit = self.circuit
+        init = time.perf_counter()
 
-        try:
-            retimings = nx.single_source_bellman_ford_path_length(G=feasibility_graph, source=extra_node)
-            retimings.pop(extra_node)
-            return True, np.array([x[1] for x in sorted(retimings.items(), key=lambda x: int(x[0]))], dtype=int)
-        except nx.exception.NetworkXUnbounded:
+        # no retiming can make the clock shorter than the slowest component
+        if clock < np.max(circuit.component_delay):
+            print("Negative cost cycle detected for clock {}...".format(clock))
+            self.instrument.event(PROBE, optimizer='opt1', clock=int(clock), feasible=False,
+                                  duration=time.perf_counter() - init, relaxations=0)
+            return False, None
+
+        # second type of constraint: r(u) - r(v) <= W(u,v) - 1 if D(u,v) > c, kept across the probes
+        constraints = self._constraint_set()
+        constraints.update(clock)
+
+        # first type of constraint from the original graph -> r(u) - r(v) <= w(e), so create arc v -> u
+        # second type of constraint -> arc v -> u with weight W(u,v) - 1
+        # the arcs of the circuit are the same for every clock, only the constraints are picked again
+        if self._circuit_arcs is None:
+            in_edges = circuit.in_edges
+            self._circuit_arcs = Arcs(len(circuit), circuit.dst[in_edges], circuit.src[in_edges],
+                                      circuit.wire_delay[in_edges], circuit.in_offsets)
+        groups = [self._circuit_arcs, constraints.arcs(len(circuit))]
+
+        # the extra node for Bellman Ford has an arc of weight 0 to all the other ones
+        stop = (lambda: self._abandoned(clock)) if self._bounds is not None else None
+        feasible, retimings, relaxations = bellman_ford_arcs(len(circuit), groups, self._warm_start_retimings(clock),
+                                                             stop)
+        if feasible is None:
+            return None, None
+        self.instrument.event(PROBE, optimizer='opt1', clock=int(clock), feasible=feasible,
+                              duration=time.perf_counter() - init, relaxations=relaxations)
+        if feasible is False:
             print("Negative cost cycle detected for clock {}...".format(clock))
             return False, None
 
+        self._feasible_retimings[clock] = retimings
+        return True, retimings
+
+    def _constraint_set(self):
+        """
+        :return: the second type constraints of OPT1, built from the pairs or from W and D the first time
+        """
+        if self._constraints is None and self.pairs is not None:
+            self._constraints = ConstraintSet.from_pairs(self.pairs)
+        elif self._constraints is None:
+            self._constraints = ConstraintSet.from_matrices(self.w, self.d, np.max(self.circuit.component_delay))
+        return self._constraints
+
+    def solve_at(self, optimizer: str, clock: int):
+        """
+        Find the retimings of a given clock with a single check, without searching, e.g. the clock of a whole
+        circuit for one of its components
+        :param optimizer: the algorithm to use
+        :param clock: a clock with a legal retiming
+        :return: void
+        """
+        self._select_checker(optimizer)
+        self._constraints = None
+        self._circuit_arcs = None
+        self._feasible_retimings = {}
+        self._seed = None
+        self.registers = None
+        self._load_results()
+        feasible, retimings = self._checker(clock)
+        self._save_results()
+        if feasible is False:
+            raise ValueError("The clock {} has no legal retiming".format(clock))
+        self.retimings = retimings
+        self.retimed_circuit = self.circuit.retime(retimings)
+        self.min_clock = clock
+
+    def min_area(self):
+        """
+        Replace the retimings found by the search with the ones meeting the same minimum clock with the fewest
+        registers. Print also the execution time
+        :return: the number of registers before and after
+        """
+        if self.matrix_free is True:
+            raise ValueError("The minimum area retiming needs the W and D matrices")
+        if self.retimed_circuit is None:
+            raise ValueError("The minimum clock must be found before the minimum area retiming")
+
+        init = time.time()
+        before = registers(self.circuit, self.retimings)
+        with self.instrument.phase(MIN_AREA, nodes=len(self.circuit), clock=int(self.min_clock)):
+            retimings = min_area_retiming(self.circuit, self._constraint_set(), self.min_clock)
+        if retimings is None:
+            raise ValueError("The clock {} has no legal retiming".format(self.min_clock))
+        self.retimings = retimings
+        self.retimed_circuit = self.circuit.retime(retimings)
+        self.registers = (before, registers(self.circuit, retimings))
+        end = time.time()
+        print("min area retiming {}".format(end - init))
+
+        print("registers: {} -> {}".format(*self.registers))
+        return self.registers
+
+    def _warm_start_retimings(self, clock: int):
+        """
+        :param clock:
+        :return: the retimings of the feasible clock nearest to the given one if warm start is enabled, otherwise the
+        retimings of the search start, if any
+        """
+        if self.warm_start is False or not self._feasible_retimings:
+            return self._seed
+        nearest = min(self._feasible_retimings, key=lambda feasible_clock: abs(feasible_clock - clock))
+        return self._feasible_retimings[nearest]
+
     def _feas_checker(self, clock: int):
         """
-        Check if a legal retiming exists given a clock duration using FEAS algorithm
+        Check if a legal retiming exists given a clock duration using FEAS algorithm. The lags are kept in an array
+        and the iterations stop as soon as the clock is met, since from then on no lag would change.
         :param clock:
         :return: If the retiming is legal and the retiming to apply
         """
-
+        circuit = self.circuit
         clock_period = self._clock_period
-        apply_retiming = self._apply_retiming
-        starting_graph = nx.DiGraph(self.graph)
+        init = time.perf_counter()
 
-        # set r(v) -> lag to 0 for each node
-        nx.set_node_attributes(G=starting_graph, values=0, name=self._lag)
+        # set r(v) -> lag to 0 for each node, or to the lags of the nearest feasible clock
+        total_retimings = self._warm_start_retimings(clock)
+        if total_retimings is None:
+            total_retimings = np.zeros(len(circuit), dtype=int)
+        else:
+            total_retimings = np.copy(total_retimings)
 
-        total_retimings = np.zeros(len(starting_graph), dtype=int)
-        delta_vs = np.zeros(len(starting_graph), dtype=int)
+        # Create Gr with the current values of r
+        wire_delay = circuit.retimed_wire_delay(total_retimings)
 
-        for _ in range(len(starting_graph) - 1):
-            # Create Gr with the current values of r
-            apply_retiming(starting_graph, delta_vs)
+        iterations = 0
+        for _ in range(len(circuit) - 1):
+            if self._bounds is not None and self._abandoned(clock):
+                return None, None
 
             # run CP algorithm to compute the delta_v of all nodes
-            clock_threshold, delta_vs = clock_period(starting_graph)
+            clock_threshold, delta_vs = clock_period(wire_delay)
+            if clock_threshold <= clock:
+                break
 
             # compute the retimings incrementing lag of 1 <=> delta_v(v) > clock
             delta_vs = np.where(delta_vs > clock, 1, 0)
-            if bool(np.any(delta_vs)) is True:
-                total_retimings = np.add(total_retimings, delta_vs)
+            total_retimings += delta_vs
+            wire_delay = wire_delay + delta_vs[circuit.dst] - delta_vs[circuit.src]
+            iterations += 1
+        else:
+            clock_threshold, _ = clock_period(wire_delay)
+
+        feasible = bool(clock_threshold <= clock)
+        self.instrument.event(PROBE, optimizer='opt2', clock=int(clock), feasible=feasible,
+                              duration=time.perf_counter() - init, iterations=iterations)
+        if feasible is True:
+            self._feasible_retimings[clock] = total_retimings
+        return feasible, total_retimings
 
-        apply_retiming(starting_graph, delta_vs)
-        clock_threshold, _ = clock_period(starting_graph)
-        return bool(clock_threshold <= clock), total_retimings
+    def _abandoned(self, clock: int):
+        """
+        :return: if the speculative search no more needs the clock
+        """
+        return not self._bounds[0] <= clock <= self._bounds[1]
 
-    def _clock_period(self, graph: nx.DiGraph):
+    def _clock_period(self, wire_delay: np.core.ndarray):
         """
         Apply the CP algorithm and compute the circuit clock period
-        :param graph:
+        :param wire_delay: the wire delay of each circuit edge
         :return:
         """
-        wire_delay = self._wire_delay
-
-        # Initialize all delta_v with the component delay
-        nodes_delay = np.copy(self.d.diagonal())
-
-        # Pick only the edges with w(e) = 0. Use the adjacency matrix to take advantage of numpy arrays
-        no_registers_adjacency = np.where(nx.to_numpy_array(graph, nodelist=sorted(graph.nodes, key=int), dtype=int, weight=wire_delay, nonedge=-1,) == 0, 1, 0)
+        if self.instrument.enabled is False:
+            return clock_period(self.circuit, wire_delay)
+        init = time.perf_counter()
+        clock, delta = clock_period(self.circuit, wire_delay)
+        self.instrument.event(CP, nodes=len(self.circuit), clock=int(clock), duration=time.perf_counter() - init)
+        return clock, delta
 
-        # Create a graph and do the topological sort
-        no_registers_graph = nx.from_numpy_matrix(no_registers_adjacency, create_using=nx.DiGraph)
 
-        sorted_nodes = nx.topological_sort(no_registers_graph)
+# State of a worker process of the speculative search, set by _init_probe_worker
+_probe_worker = {}
 
-        for node in sorted_nodes:
-            node = int(node)
 
-            # Get incident edges
-            incident_edges = no_registers_adjacency[:, node]
+def _share(matrix: np.ndarray):
+    """
+    :param matrix:
+    :return: a reference the workers can attach to and the shared memory to release, None for memory-mapped files
+    """
+    if isinstance(matrix, np.memmap) and matrix.filename is not None:
+        return ('memmap', matrix.filename), None
+    shared = shared_memory.SharedMemory(create=True, size=max(1, matrix.nbytes))
+    view = np.ndarray(matrix.shape, dtype=matrix.dtype, buffer=shared.buf)
+    view[:] = matrix
+    del view
+    return ('shared', shared.name, matrix.shape, matrix.dtype.str), shared
 
-            try:
-                incident_edges = np.where(incident_edges > 0)
-            except:
-                incident_edges = None
 
-            # In case of incident edges add the maximum d(u) between all the arcs u -> v
-            if incident_edges is not None and incident_edges[0].size > 0:
-                nodes_delay[node] = nodes_delay[node] + np.max(nodes_delay[incident_edges])
+def _attach(reference: tuple):
+    """
+    :param reference: a reference returned by _share
+    :return: the matrix and the shared memory it lives in, if any
+    """
+    if reference[0] == 'memmap':
+        return np.load(reference[1], mmap_mode='r'), None
+    shared = shared_memory.SharedMemory(name=reference[1])
+    return np.ndarray(reference[2], dtype=reference[3], buffer=shared.buf), shared
 
-        return np.max(nodes_delay), nodes_delay
 
-    def _apply_retiming(self, graph: nx.DiGraph, retimings):
-        """
-            Apply the retiming to the graph.
-            :param graph:
-            :param retimings:
-            :return: the retimed graph
-            """
-        nx.set_edge_attributes(G=graph,
-                               values={(v1, v2): (graph[v1][v2][self._wire_delay] + retimings[int(v2)] - retimings[int(v1)])
-                                   for
-                                   (v1, v2)
-                                   in
-                                   graph.edges}, name=self._wire_delay)
+def _init_probe_worker(circuit: Circuit, optimizer: str, matrices: list, pairs=None, bounds=None):
+    """
+    Build the OPT instance of a worker process of the speculative search
+    :param matrices: references to W and D, empty if the checker does not need them
+    :param pairs: pairs computed by the sparse WD, if any
+    :param bounds: shared lowest and highest clock still relevant, the probes of the other clocks stop early
+    """
+    w, d = None, None
+    if matrices:
+        (w, shared_w), (d, shared_d) = [_attach(reference) for reference in matrices]
+        _probe_worker['shared'] = (shared_w, shared_d)
+    worker = OPT(circuit, w, d)
+    worker.pairs = pairs
+    worker._bounds = bounds
+    worker._select_checker(optimizer)
+    _probe_worker['opt'] = worker
+
+
+def _probe(clock: int):
+    """
+    Check a clock inside a worker process
+    :return: If the retiming is legal and the retiming to apply, None and None if the search no more needs it
+    """
+    return _probe_worker['opt']._checker(clock)
@@ -1,33 +1,280 @@
-import networkx as nx
-import matplotlib.pyplot as plt
+from __future__ import annotations
+
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING
+
+import numpy as np
+from src.cache import cache
+from src.circuit.circuit import Circuit
+from src.instrument.instrument import PREPROCESS, Instrument
 from src.opt import opt
 from src.wd import wd
 
+# networkx is imported only by the methods using the graphs and matplotlib only to draw them, so a retiming of a
+# Circuit loads neither
+if TYPE_CHECKING:
+    import networkx as nx
+
+# components are solved in tasks of at least this number of nodes, so the small ones share a task
+_TASK_NODES = 256
+
 
 class Retimer:
     """
     Performs retiming
     """
 
-    def __init__(self, unopt_graph: nx.DiGraph, print_matrices=False):
-        self.graph = self.preprocess_graph(unopt_graph)
-        self.wd = wd.WD(graph=self.graph, print_wd=print_matrices)
-        self.opt = opt.OPT(self.graph, self.wd.w, self.wd.d)
-        self.retimed_graph = None
+    def __init__(self, unopt_graph, print_matrices=False, wd_engine=wd.DIJKSTRA, wd_jobs=None,
+                 wd_memmap_dir=None, wd_sparse=False, cache_dir=None, cache_size=cache.DEFAULT_SIZE, instrument=None):
+        """
+        :param unopt_graph: the graph to retime, or directly its Circuit. In the latter case the graphs are built
+        only if they are accessed
+        :param cache_dir: directory of the persistent cache of W, D and the clocks already checked, None to disable it
+        :param cache_size: size in bytes over which the least recently used circuits are evicted from the cache
+        :param instrument: receiver of the phases and events of WD and OPT, see src.instrument.instrument
+        """
+        self.instrument = instrument if instrument is not None else Instrument()
+        if isinstance(unopt_graph, Circuit):
+            self._graph = None
+            self.circuit = unopt_graph
+        else:
+            with self.instrument.phase(PREPROCESS, nodes=len(unopt_graph)):
+                self._graph = self.preprocess_graph(unopt_graph)
+                self.circuit = Circuit.from_graph(self._graph)
+        self.wd = wd.WD(circuit=self.circuit, print_wd=print_matrices, engine=wd_engine, jobs=wd_jobs,
+                        memmap_dir=wd_memmap_dir, sparse=wd_sparse)
+        self.wd.instrument = self.instrument
+        self.opt = opt.OPT(self.circuit, self.wd.w, self.wd.d)
+        self.opt.instrument = self.instrument
+        self._cache = None
+        self.cache = None
+        if cache_dir is not None:
+            self._cache = cache.Cache(cache_dir, cache_size)
+            self.cache = self._cache.entry(self.circuit)
+            self.wd.cache = self.cache
+            self.opt.cache = self.cache
+        self._retimed_graph = None
         self.node_mapping = []
 
-    def retime(self, optimizer='opt1'):
+    def use_instrument(self, instrument: Instrument):
+        """
+        Send the next phases and events of WD and OPT to another instrument
+        :param instrument:
+        :return: void
+        """
+        self.instrument = instrument
+        self.wd.instrument = instrument
+        self.opt.instrument = instrument
+
+    @property
+    def graph(self) -> nx.DiGraph:
+        """
+        :return: the preprocessed graph, built from the circuit the first time if the retimer was given a Circuit
+        """
+        if self._graph is None:
+            self._graph = self.circuit.to_graph()
+        return self._graph
+
+    @graph.setter
+    def graph(self, graph: nx.DiGraph):
+        """
+        Retime another preprocessed graph, e.g. this one after moving its registers. W, D and the last retiming are
+        dropped
+        :param graph: a graph with the integer nodes and the int delays, see preprocess_graph
+        :return: void
+        """
+        self._graph = graph
+        self.circuit = Circuit.from_graph(graph)
+        self.wd = wd.WD(self.circuit, self.wd.print_wd, self.wd.engine, self.wd.block_size, self.wd.jobs,
+                        self.wd.memmap_dir, self.wd.sparse)
+        self.wd.instrument = self.instrument
+        self.opt = opt.OPT(self.circuit, self.wd.w, self.wd.d)
+        self.opt.instrument = self.instrument
+        if self._cache is not None:
+            self.cache = self._cache.entry(self.circuit)
+            self.wd.cache = self.cache
+            self.opt.cache = self.cache
+        self._retimed_graph = None
+
+    @property
+    def retimed_graph(self) -> nx.DiGraph:
+        """
+        :return: the retimed graph with the original node names, None before retime
+        """
+        if self._retimed_graph is None and self.opt.retimed_circuit is not None:
+            import networkx as nx
+
+            # OPT retimes the circuit as it was given, so the retimings always apply to the unretimed graph
+            if self._graph is not None:
+                graph = self._graph.copy()
+                self._apply_retiming(graph, self.opt.retimings)
+            else:
+                graph = self.opt.retimed_circuit.to_graph()
+            mappings = nx.get_node_attributes(graph, 'original-id')
+            self._retimed_graph = nx.relabel_nodes(graph, mappings)
+        return self._retimed_graph
+
+    def retime(self, optimizer='opt1', warm_start=False, search_jobs=1, batched=False, matrix_free=False,
+               min_area=False, components=False, component_jobs=None):
         """
         Executes WD and OPT algorithms
         :param optimizer:
+        :param warm_start: start each check from the solution of the nearest feasible clock already found
+        :param search_jobs: if greater than 1, number of clocks checked at once by a pool of processes
+        :param batched: check all the candidate clocks in one vectorized pass (opt2 only)
+        :param matrix_free: skip WD and search the clock among all the integer values (opt2 only)
+        :param min_area: once the minimum clock is found, retime with the fewest registers that meet it
+        :param components: solve each weakly connected component of the circuit on its own, see retime_components
+        :param component_jobs: number of processes solving the components, all the CPUs if None
         :return:
         """
-        self.wd.wd()
+        if components is True and len(self.circuit.components()) > 1:
+            self.retime_components(optimizer, component_jobs, warm_start=warm_start, search_jobs=search_jobs,
+                                   batched=batched, matrix_free=matrix_free, min_area=min_area)
+            return
+
+        # W and D of the circuit are kept between the retimings, and moved along by update
+        if matrix_free is False and self.wd.w is None and self.wd.pairs is None:
+            self.wd.wd()
         self.opt.w = self.wd.w
         self.opt.d = self.wd.d
+        self.opt.pairs = self.wd.pairs
+        self.opt.matrix_free = matrix_free
+        self.opt.warm_start = warm_start
+        self.opt.search_jobs = search_jobs
+        self.opt.batched = batched
         self.opt.opt(optimizer)
-        mappings = nx.get_node_attributes(self.graph, 'original-id')
-        self.retimed_graph = nx.relabel_nodes(self.opt.graph, mappings)
+        if min_area is True:
+            self.opt.min_area()
+        self._update_retimed_graph()
+
+    def retime_components(self, optimizer='opt1', jobs=None, **options):
+        """
+        Retime each weakly connected component on its own, in a pool of processes: W and D of a component only
+        cover its own pairs, so their cost is quadratic in the size of the component instead of the whole circuit.
+        The clock of the circuit is the highest minimum clock of the components. The components with a lower one
+        are checked again at that clock, so the retimings are the ones the whole circuit would get: no constraint
+        links two components, so both Bellman Ford and FEAS treat them independently. This second check, and the
+        minimum area retiming, run in the processes too: only the clocks and the retimings come back, W and D of the
+        components stay in their memory-mapped files, or are computed again for the components checked twice by
+        Bellman Ford or retimed with the minimum area, FEAS does without them.
+        W and D of the whole circuit are never built, so an update afterwards computes them from scratch.
+        The FEAS iterations and the Bellman Ford rounds on the whole circuit advance all the components at once, so
+        with many small components and few processes the search can be slower than on the whole circuit.
+        :param optimizer:
+        :param jobs: number of processes, all the CPUs if None. With 1 the components are solved in this process
+        :param options: the other arguments of retime
+        :return: void
+        """
+        min_area = options.pop('min_area', False)
+        wd_options = {'print_matrices': self.wd.print_wd, 'wd_engine': self.wd.engine, 'wd_jobs': self.wd.jobs,
+                      'wd_memmap_dir': self.wd.memmap_dir, 'wd_sparse': self.wd.sparse,
+                      'cache_dir': self._cache.directory if self._cache is not None else None,
+                      'cache_size': self._cache.size if self._cache is not None else cache.DEFAULT_SIZE}
+        components = self.circuit.components()
+        subcircuits = [self.circuit.subcircuit(nodes) for nodes in components]
+
+        # single nodes need no search: their clock is their delay and they are never retimed
+        solved = [(int(subcircuit.component_delay[0]), np.zeros(1, dtype=np.int64))
+                  if len(subcircuit) == 1 else None for subcircuit in subcircuits]
+        # registers before and after, the ones on the self-loops of the single nodes never move
+        registers = np.zeros(2, dtype=np.int64)
+        for subcircuit in subcircuits:
+            if len(subcircuit) == 1:
+                registers += int(np.sum(subcircuit.wire_delay))
+
+        # memory-mapped W and D of each component, kept on disk by the first pass for the second one
+        files = [None] * len(subcircuits)
+        pool = ProcessPoolExecutor(max_workers=jobs) if jobs != 1 else None
+        try:
+            solve = pool.map if pool is not None else map
+            tasks = _component_tasks([index for index, result in enumerate(solved) if result is None], subcircuits)
+            arguments = [([subcircuits[index] for index in task], optimizer, wd_options, options) for task in tasks]
+            for task, task_results in zip(tasks, solve(_solve_components, arguments)):
+                for index, (result, component_files) in zip(task, task_results):
+                    solved[index] = result
+                    files[index] = component_files
+
+            # the components with a lower clock are checked again at the clock of the circuit, in the processes too,
+            # reading W and D back from their memory-mapped files or from the cache when there are any
+            clock = max(min_clock for min_clock, _ in solved)
+            pending = [index for index, (min_clock, _) in enumerate(solved)
+                       if len(subcircuits[index]) > 1 and (min_clock < clock or min_area is True)]
+            tasks = _component_tasks(pending, subcircuits)
+            arguments = [([subcircuits[index] for index in task], [solved[index] for index in task],
+                          [files[index] for index in task], clock, optimizer, wd_options, options, min_area)
+                         for task in tasks]
+            for task, task_results in zip(tasks, solve(_finish_components, arguments)):
+                for index, (component_retimings, component_registers) in zip(task, task_results):
+                    solved[index] = (clock, component_retimings)
+                    if min_area is True:
+                        registers += component_registers
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+            for component_files in files:
+                if component_files is not None and component_files[0] is not None:
+                    shutil.rmtree(component_files[0], ignore_errors=True)
+
+        retimings = np.zeros(len(self.circuit), dtype=np.int64)
+        for nodes, (_, component_retimings) in zip(components, solved):
+            retimings[nodes] = component_retimings
+
+        self.opt._optimizer = optimizer
+        self.opt.retimings = retimings
+        self.opt.retimed_circuit = self.circuit.retime(retimings)
+        self.opt.min_clock, _ = self.opt._clock_period(self.opt.retimed_circuit.wire_delay)
+        self.opt.registers = (int(registers[0]), int(registers[1])) if min_area is True else None
+        print("minimum clock cycle: {}".format(self.opt.min_clock))
+        self._update_retimed_graph()
+
+    def update(self, edits, optimizer=None):
+        """
+        Edit the circuit and retime it again. Only the rows of W and D that the edits can change are computed again
+        and the search starts from the previous minimum clock and retiming. If the last retiming had the minimum
+        area, so does the new one.
+        The graph is built again from the edited circuit, so attributes other than the delays are lost.
+        :param edits: list of edits, see Circuit.edit. Nodes are the integers of the circuit
+        :param optimizer: the algorithm to use, the one of the last retime if None
+        :return: the number of rows of W and D computed again
+        """
+        start = (self.opt.min_clock, self.opt.retimings) if self.opt.retimed_circuit is not None else None
+        min_area = self.opt.registers is not None
+        circuit = self.circuit.edit(edits)
+
+        self.circuit = circuit
+        self._graph = None
+        if self._cache is not None:
+            self.cache = self._cache.entry(circuit)
+            self.wd.cache = self.cache
+            self.opt.cache = self.cache
+
+        rows = 0
+        if self.opt.matrix_free is True:
+            self.wd = wd.WD(circuit, self.wd.print_wd, self.wd.engine, self.wd.block_size, self.wd.jobs,
+                            self.wd.memmap_dir, self.wd.sparse)
+            self.wd.cache = self.cache
+            self.wd.instrument = self.instrument
+        else:
+            rows = self.wd.update(circuit, edits)
+        self.opt.circuit = circuit
+        self.opt.w = self.wd.w
+        self.opt.d = self.wd.d
+        self.opt.pairs = self.wd.pairs
+        self.opt.opt(optimizer or self.opt._optimizer or 'opt1', start)
+        if min_area is True:
+            self.opt.min_area()
+        self._update_retimed_graph()
+        return rows
+
+    def _update_retimed_graph(self):
+        """
+        Drop the retimed graph of the previous retiming, the next access builds it from the new one
+        :return: void
+        """
+        self._retimed_graph = None
 
     def preprocess_graph(self, graph: nx.DiGraph) -> nx.DiGraph:
         """
@@ -35,6 +282,8 @@ class Retimer:
         :param graph:
         :return:
         """
+        import networkx as nx
+
         graph = nx.convert_node_labels_to_integers(
             graph, first_label=0, label_attribute='original-id')
         component_delay = nx.get_node_attributes(
@@ -50,6 +299,92 @@ class Retimer:
         nx.set_edge_attributes(G=graph, values=weights, name='wire_delay')
         return graph
 
+    def _apply_retiming(self, graph: nx.DiGraph, retimings):
+        """
+        Apply the retiming to the graph.
+        :param graph:
+        :param retimings:
+        :return: void
+        """
+        import networkx as nx
+
+        nx.set_edge_attributes(G=graph,
+                               values={(v1, v2): (graph[v1][v2]['wire_delay'] + retimings[v2] - retimings[v1])
+                                       for (v1, v2) in graph.edges}, name='wire_delay')
+
+
+def _component_tasks(indices: list, subcircuits: list):
+    """
+    Group the components, largest first, so that each task has at least _TASK_NODES nodes
+    :param indices: indices of the components to solve, sorted by decreasing size
+    :param subcircuits: the circuit of each component
+    :return: list of tasks, each a list of indices
+    """
+    tasks = []
+    nodes = _TASK_NODES
+    for index in indices:
+        if nodes >= _TASK_NODES:
+            tasks.append([])
+            nodes = 0
+        tasks[-1].append(index)
+        nodes += len(subcircuits[index])
+    return tasks
+
+
+def _solve_components(arguments: tuple):
+    """
+    Retime some components inside a worker process
+    :param arguments: the circuits of the components, the optimizer, the arguments of Retimer and
+    of retime. Each component keeps its memory-mapped W and D in its own subdirectory, see WD.memmap_path
+    :return: for each component the minimum clock and the retimings, and the files of W and D if they are
+    memory-mapped: the directory to remove once done, None if they come from the cache, and the paths of W and D
+    """
+    subcircuits, optimizer, wd_options, options = arguments
+    results = []
+    for subcircuit in subcircuits:
+        retimer = Retimer(subcircuit, **wd_options)
+        retimer.retime(optimizer, **options)
+        files = None
+        if isinstance(retimer.wd.w, np.memmap) and isinstance(retimer.wd.d, np.memmap):
+            retimer.wd.keep_files()
+            files = (retimer.wd.memmap_path, retimer.wd.w.filename, retimer.wd.d.filename)
+        results.append(((int(retimer.opt.min_clock), retimer.opt.retimings), files))
+    return results
+
+
+def _finish_components(arguments: tuple):
+    """
+    Retime some components inside a worker process at the clock of the whole circuit, with the fewest registers if
+    min_area is set. W and D are only needed by Bellman Ford and the minimum area retiming: they are read back from
+    the memory-mapped files or the cache of the component if it has any, or else computed again
+    :param arguments: the circuits of the components, their minimum clock and retimings, the files
+    of their W and D, the clock of the circuit, the optimizer, the arguments of Retimer and of retime and min_area
+    :return: for each component the retimings and the registers before and after the minimum area retiming
+    """
+    subcircuits, solved, files, clock, optimizer, wd_options, options, min_area = arguments
+    matrix_free = options.get('matrix_free', False)
+    needs_wd = matrix_free is False and (optimizer == 'opt1' or min_area is True)
+    results = []
+    for subcircuit, (min_clock, retimings), component_files in zip(subcircuits, solved, files):
+        retimer = Retimer(subcircuit, **wd_options)
+        if needs_wd is True and component_files is not None:
+            retimer.wd.w = np.load(component_files[1], mmap_mode='r')
+            retimer.wd.d = np.load(component_files[2], mmap_mode='r')
+        elif needs_wd is True:
+            retimer.wd.wd()
+        component_opt = retimer.opt
+        component_opt.w, component_opt.d, component_opt.pairs = retimer.wd.w, retimer.wd.d, retimer.wd.pairs
+        component_opt.matrix_free = matrix_free
+        if min_clock < clock:
+            component_opt.solve_at(optimizer, clock)
+        else:
+            component_opt.retimings = retimings
+            component_opt.retimed_circuit = subcircuit.retime(retimings)
+            component_opt.min_clock = clock
+        component_registers = component_opt.min_area() if min_area is True else None
+        results.append((component_opt.retimings, component_registers))
+    return results
+
 
 def draw_graph(graph: nx.DiGraph, draw_node_labels=False):
     """
@@ -58,6 +393,9 @@ def draw_graph(graph: nx.DiGraph, draw_node_labels=False):
     :param graph:
     :return:
     """
+    import matplotlib.pyplot as plt
+    import networkx as nx
+
     if draw_node_labels is True:
         nx.draw(graph, pos=nx.circular_layout(graph), font_weight='bold')
         nx.draw_networkx_labels(graph, pos=nx.circular_layout(graph),
@@ -70,10 +408,19 @@ def draw_graph(graph: nx.DiGraph, draw_node_labels=False):
     plt.show()
 
 
-def save_graph(g, path): 
-    g = g.copy() 
-    for v in g.nodes: 
-        g.nodes[v]['label'] = f'{v};{g.nodes[v]["component_delay"]}' 
-        for e in g.edges: 
-            g.edges[e]['label'] = g.edges[e]['wire_delay'] 
-            nx.nx_agraph.write_dot(g, path)
+def save_graph(g, path):
+    """
+    Write a graph with the labels drawn by graphviz. run.py writes the retimed circuits with the streaming
+    src.utils.export instead, which does not need the graph
+    :param g:
+    :param path:
+    :return: void
+    """
+    import networkx as nx
+
+    g = g.copy()
+    for v in g.nodes:
+        g.nodes[v]['label'] = f'{v};{g.nodes[v]["component_delay"]}'
+    for e in g.edges:
+        g.edges[e]['label'] = g.edges[e]['wire_delay']
+    nx.nx_agraph.write_dot(g, path)
@@ -0,0 +1,346 @@
+import asyncio
+import json
+import socket
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from src.cache.cache import circuit_key
+from src.circuit.circuit import Circuit
+from src.instrument.instrument import CP, Instrument
+from src.retimer.retimer import Retimer
+from src.utils import dot, export, utilities
+
+# Default upper bound on the bytes of the circuits kept warm, W and D included
+DEFAULT_WARM_BYTES = 1 << 30
+
+# A circuit differing from a warm one by at most this number of edits is retimed with Retimer.update
+MAX_EDITS = 64
+
+# Arguments of Retimer.retime accepted in the requests, besides the optimizer
+RETIME_OPTIONS = ('warm_start', 'search_jobs', 'batched', 'matrix_free', 'min_area')
+
+# Modes of a result: retimed from scratch, answered by a warm circuit, searched again on the warm W and D of the
+# circuit with other options, moved from a warm circuit by its edits
+COLD = 'cold'
+WARM = 'warm'
+SEARCH = 'search'
+UPDATE = 'update'
+
+
+class RetimingService:
+    """
+    Local retiming service speaking JSON lines over a Unix socket or a localhost TCP port.
+    Each request is a JSON object on a line. The ones with "op": "retime" carry a circuit as
+    - "dot": the text of a .dot file
+    - "path": the path of a .dot or .npz file readable by the service
+    - "circuit": the arrays component_delay, src, dst, wire_delay and optionally names
+    and optionally "id", "optimizer", the options in RETIME_OPTIONS, "base" (the key of the warm circuit to move
+    from) and "output" (where to write the retimed circuit, in the format of its extension, see src.utils.export).
+    They are queued and run by a pool of threads. The answer is a stream of JSON lines with the id of the request:
+    "queued", one "phase" per phase of WD and OPT, one "probe" per clock checked, then "result" or "error".
+    The retimers of the last circuits, W and D included, are kept in memory up to warm_bytes, least recently used
+    first out. A circuit already warm is answered at once, one differing from a warm circuit by a few edits is moved
+    from it with Retimer.update, which takes the place of the warm one. The other requests are "stats" and "evict".
+    """
+
+    def __init__(self, jobs=1, warm_bytes=DEFAULT_WARM_BYTES, max_edits=MAX_EDITS, **retimer_options):
+        """
+        :param jobs: number of circuits retimed at once
+        :param warm_bytes: upper bound on the bytes of the circuits kept in memory
+        :param max_edits: circuits differing from a warm one by more edits are retimed from scratch
+        :param retimer_options: arguments of Retimer for the new circuits, e.g. wd_engine or cache_dir
+        """
+        self.jobs = jobs
+        self.warm_bytes = warm_bytes
+        self.max_edits = max_edits
+        self.retimer_options = retimer_options
+        # key of the circuit -> (retimer, options of its last retiming)
+        self._warm = OrderedDict()
+        self._executor = ThreadPoolExecutor(max_workers=jobs)
+        self._queue = None
+        self._loop = None
+        self._requests = 0
+
+    async def serve(self, path=None, host='127.0.0.1', port=None):
+        """
+        Accept connections until cancelled
+        :param path: path of the Unix socket, if None the service listens on host and port
+        :param host:
+        :param port:
+        :return: void
+        """
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        workers = [asyncio.ensure_future(self._worker()) for _ in range(self.jobs)]
+        if path is not None:
+            server = await asyncio.start_unix_server(self._connection, path=path)
+        else:
+            server = await asyncio.start_server(self._connection, host=host, port=port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self._executor.shutdown(wait=False)
+
+    async def _connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Read the requests of a client, one per line, until it closes the connection
+        """
+        pending = []
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    done = self._handle(line, writer)
+                    if done is not None:
+                        pending.append(done)
+        finally:
+            # the client may stop writing before the answers are over
+            await asyncio.gather(*pending)
+            writer.close()
+
+    def _handle(self, line: bytes, writer: asyncio.StreamWriter):
+        """
+        Queue a retiming or answer the other requests at once
+        :return: a future set when the retiming is over, None for the other requests
+        """
+        self._requests += 1
+        try:
+            request = json.loads(line)
+        except ValueError as error:
+            _send(writer, {'id': None, 'event': 'error', 'error': "invalid JSON: {}".format(error)})
+            return
+        request.setdefault('id', self._requests)
+        op = request.get('op', 'retime')
+
+        if op == 'retime':
+            done = self._loop.create_future()
+            self._queue.put_nowait((request, writer, done))
+            _send(writer, {'id': request['id'], 'event': 'queued', 'position': self._queue.qsize()})
+            return done
+        elif op == 'stats':
+            _send(writer, {'id': request['id'], 'event': 'stats', 'queued': self._queue.qsize(),
+                           'warm_bytes': sum(_retimer_bytes(retimer) for retimer, _ in self._warm.values()),
+                           'warm': [{'key': key, 'nodes': len(retimer.circuit)}
+                                    for key, (retimer, _) in self._warm.items()]})
+        elif op == 'evict':
+            evicted = self._warm.pop(request.get('key'), None) is not None
+            _send(writer, {'id': request['id'], 'event': 'evicted', 'evicted': evicted})
+        else:
+            _send(writer, {'id': request['id'], 'event': 'error', 'error': "unknown op {}".format(op)})
+        return None
+
+    async def _worker(self):
+        """
+        Run the queued retimings one at a time
+        """
+        while True:
+            request, writer, done = await self._queue.get()
+            try:
+                await self._retime(request, writer)
+            except Exception as error:
+                _send(writer, {'id': request['id'], 'event': 'error',
+                               'error': "{}: {}".format(type(error).__name__, error)})
+            finally:
+                done.set_result(None)
+
+    async def _retime(self, request: dict, writer: asyncio.StreamWriter):
+        """
+        Pick the warm retimer to start from, if any, then retime in the pool. The retimer in use is out of the warm
+        set, so no other worker can pick it at the same time
+        """
+        init = time.perf_counter()
+        loop = self._loop
+        optimizer = request.get('optimizer', 'opt1')
+        options = {name: request[name] for name in RETIME_OPTIONS if name in request}
+        circuit = await loop.run_in_executor(self._executor, _read_circuit, request)
+        key = await loop.run_in_executor(self._executor, circuit_key, circuit)
+
+        mode, retimer, edits = COLD, None, None
+        if key in self._warm:
+            mode = WARM
+            retimer, previous = self._warm.pop(key)
+            if previous != (optimizer, options):
+                mode = SEARCH
+        else:
+            base = await self._base(circuit, request.get('base'), (optimizer, options))
+            if base is not None:
+                mode = UPDATE
+                retimer, edits = base
+
+        progress = _Progress(lambda message: loop.call_soon_threadsafe(_send, writer, dict(message, id=request['id'])))
+        retimer, rows = await loop.run_in_executor(self._executor, self._run, mode, retimer, circuit, edits,
+                                                   optimizer, options, progress)
+        self._warm[key] = (retimer, (optimizer, options))
+        self._evict()
+
+        if request.get('output') is not None:
+            await loop.run_in_executor(self._executor, export.export_retiming, retimer.circuit, retimer.opt.retimings,
+                                       request['output'])
+        _send(writer, {'id': request['id'], 'event': 'result', 'key': key, 'mode': mode, 'rows': rows,
+                       'min_clock': retimer.opt.min_clock, 'retimings': retimer.opt.retimings,
+                       'registers': retimer.opt.registers, 'duration': time.perf_counter() - init})
+
+    def _run(self, mode: str, retimer, circuit: Circuit, edits, optimizer: str, options: dict, progress):
+        """
+        Retime inside a thread of the pool
+        :return: the retimer and the number of rows of W and D computed again by an update
+        """
+        if mode == WARM:
+            return retimer, 0
+        if mode == UPDATE:
+            retimer.use_instrument(progress)
+            rows = retimer.update(edits, optimizer)
+            if options.get('min_area', False) is True and retimer.opt.registers is None:
+                retimer.opt.min_area()
+            retimer.use_instrument(Instrument())
+            return retimer, rows
+
+        if mode == COLD:
+            # with wd_memmap_dir the files of W and D of each retimer go to a subdirectory of their own, removed
+            # with the retimer when it is evicted, see WD.memmap_path
+            retimer = Retimer(circuit, **self.retimer_options)
+        retimer.use_instrument(progress)
+        retimer.retime(optimizer, **options)
+        retimer.use_instrument(Instrument())
+        return retimer, len(circuit) if mode == COLD else 0
+
+    async def _base(self, circuit: Circuit, key, settings: tuple):
+        """
+        Compare the circuit with the warm ones in the pool, since each comparison walks all the edges
+        :param circuit: the circuit to retime
+        :param key: the key of the warm circuit to start from, the most recently used one with the same nodes if None
+        :param settings: optimizer and options of the request, an update keeps the ones of the warm circuit
+        :return: the warm retimer taken out of the warm set and the edits to apply, None if no warm circuit is close
+        """
+        candidates = [key] if key is not None else list(reversed(self._warm))
+        for candidate in candidates:
+            if candidate not in self._warm:
+                continue
+            retimer, previous = self._warm[candidate]
+            if previous != settings or retimer.opt.retimed_circuit is None:
+                continue
+            edits = await self._loop.run_in_executor(self._executor, retimer.circuit.edits_to, circuit)
+            # another worker may have taken the retimer, or an eviction dropped it, during the comparison
+            if self._warm.get(candidate, (None, None))[0] is not retimer:
+                continue
+            if edits is not None and len(edits) <= self.max_edits:
+                del self._warm[candidate]
+                return retimer, edits
+        return None
+
+    def _evict(self):
+        """
+        Drop the least recently used circuits until the warm ones fit, always keeping the last one
+        """
+        total = sum(_retimer_bytes(retimer) for retimer, _ in self._warm.values())
+        while total > self.warm_bytes and len(self._warm) > 1:
+            _, (retimer, _) = self._warm.popitem(last=False)
+            total -= _retimer_bytes(retimer)
+
+
+class _Progress(Instrument):
+    """
+    Instrument forwarding the phases and the probes, but not the CP calls, to a client
+    """
+
+    enabled = True
+
+    def __init__(self, send):
+        self._send = send
+
+    def phase_ended(self, name: str, duration: float, fields: dict):
+        self._send(dict(fields, event='phase', phase=name, duration=duration))
+
+    def event(self, name: str, **fields):
+        if name != CP:
+            self._send(dict(fields, event=name))
+
+
+def _read_circuit(request: dict):
+    """
+    :return: the circuit of a request
+    """
+    if 'dot' in request:
+        return dot.parse_circuit(request['dot'].splitlines(keepends=True))
+    if 'path' in request:
+        return utilities.load_circuit(request['path'])
+    if 'circuit' in request:
+        arrays = request['circuit']
+        return Circuit(arrays['component_delay'], arrays['src'], arrays['dst'], arrays['wire_delay'],
+                       arrays.get('names'))
+    raise ValueError("The request has no dot, path or circuit")
+
+
+def _retimer_bytes(retimer: Retimer):
+    """
+    :return: the bytes of the arrays kept in memory by a retimer, the memory-mapped ones excluded: the circuit, W and
+    D, and what OPT keeps for the next searches, i.e. the constraints, the feasible retimings and the retimed circuit
+    """
+    arrays = _circuit_arrays(retimer.circuit) + [retimer.wd.w, retimer.wd.d, retimer.opt.retimings]
+    if retimer.wd.pairs is not None:
+        arrays += [retimer.wd.pairs.sources, retimer.wd.pairs.targets, retimer.wd.pairs.w, retimer.wd.pairs.d]
+    constraints = retimer.opt._constraints
+    if constraints is not None:
+        arrays += [constraints.sources, constraints.targets, constraints.weights, constraints.delays]
+    arrays += list(retimer.opt._feasible_retimings.values())
+    if retimer.opt.retimed_circuit is not None:
+        arrays += _circuit_arrays(retimer.opt.retimed_circuit)
+    # the retimings found are also among the feasible ones, each array is counted once
+    arrays = {id(array): array for array in arrays
+              if isinstance(array, np.ndarray) and not isinstance(array, np.memmap)}
+    return sum(array.nbytes for array in arrays.values())
+
+
+def _circuit_arrays(circuit: Circuit):
+    """
+    :return: the arrays of a circuit, the CSR offsets included
+    """
+    return [circuit.component_delay, circuit.src, circuit.dst, circuit.wire_delay, circuit.out_offsets,
+            circuit.in_edges, circuit.in_offsets]
+
+
+def _send(writer: asyncio.StreamWriter, message: dict):
+    if not writer.is_closing():
+        writer.write(json.dumps(message, default=_json_default).encode() + b'\n')
+
+
+def _json_default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, tuple):
+        return list(value)
+    raise TypeError("{} is not JSON serializable".format(type(value).__name__))
+
+
+def request(message: dict, path=None, host='127.0.0.1', port=None):
+    """
+    Blocking client: send a request and read its answer
+    :param message: the request
+    :param path: path of the Unix socket of the service, if None host and port are used
+    :param host:
+    :param port:
+    :return: generator of the JSON lines answering the request, up to its result or error
+    """
+    if path is not None:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(path)
+    else:
+        connection = socket.create_connection((host, port))
+    with connection, connection.makefile('rb') as lines:
+        connection.sendall(json.dumps(message, default=_json_default).encode() + b'\n')
+        connection.shutdown(socket.SHUT_WR)
+        for line in lines:
+            answer = json.loads(line)
+            yield answer
+            if answer['event'] not in ('queued', 'phase', 'probe'):
+                break
@@ -0,0 +1,177 @@
+import re
+
+from src.circuit.circuit import Circuit
+
+_QUOTED = r'"(?:[^"\\]|\\.)*"'
+_ID = _QUOTED + r'|[\w.\-]+'
+_ATTRIBUTES = r'(?:\[(?P<attributes>(?:' + _QUOTED + r'|[^\]"])*)\])?'
+_HEADER = re.compile(r'^(?:strict\s+)?digraph\b\s*(?P<name>' + _ID + r')?\s*\{$')
+_DEFAULTS = re.compile(r'^(?P<kind>graph|node|edge)\s*' + _ATTRIBUTES + r'$', re.DOTALL)
+_EDGE = re.compile(r'^(?P<tail>' + _ID + r')\s*->\s*(?P<head>' + _ID + r')\s*' + _ATTRIBUTES + r'$', re.DOTALL)
+_NODE = re.compile(r'^(?P<node>' + _ID + r')\s*' + _ATTRIBUTES + r'$', re.DOTALL)
+_ATTRIBUTE = re.compile(r'(' + _ID + r')\s*=\s*(' + _QUOTED + r'|[^,;\s\]]+)')
+_STATEMENTS = re.compile(r'(?:' + _QUOTED + r'|[^;"])+')
+
+
+def read_circuit(path: str) -> Circuit:
+    """
+    Streaming parser of the DOT subset used by the circuits: a (strict) digraph whose statements are nodes with a
+    component_delay and edges with a wire_delay. A statement ends with the line unless its attribute list is still
+    open. The nodes are numbered in order of first appearance, as networkx does, and a repeated edge keeps the last
+    wire_delay, as in a strict digraph.
+    :param path:
+    :return: the circuit, with the DOT ids as node names
+    """
+    with open(path) as dot:
+        return parse_circuit(dot, path)
+
+
+def parse_circuit(lines, path='<string>') -> Circuit:
+    """
+    Parser of read_circuit on any iterable of lines, e.g. dot_text.splitlines(keepends=True)
+    :param lines:
+    :param path: name of the source in the error messages
+    :return: the circuit, with the DOT ids as node names
+    """
+    nodes = {}
+    graph_name = None
+    component_delay = []
+    edges = {}
+    defaults = {'node': {}, 'edge': {}}
+
+    def node_index(name: str):
+        index = nodes.get(name)
+        if index is None:
+            index = nodes[name] = len(component_delay)
+            component_delay.append(defaults['node'].get('component_delay'))
+        return index
+
+    pending = ''
+    for number, line in enumerate(lines, start=1):
+        pending += line
+        unquoted = re.sub(_QUOTED, '', pending)
+        if unquoted.count('[') > unquoted.count(']'):
+            continue
+        text, pending = pending, ''
+
+        for statement in _STATEMENTS.findall(text):
+            statement = statement.strip()
+            if not statement or statement == '}':
+                continue
+            match = _HEADER.match(statement)
+            if match:
+                graph_name = _unquote(match.group('name')) if match.group('name') else None
+                continue
+
+            match = _EDGE.match(statement)
+            if match:
+                attributes = _parse_attributes(match.group('attributes'), defaults['edge'])
+                tail = node_index(_unquote(match.group('tail')))
+                head = node_index(_unquote(match.group('head')))
+                edges[tail, head] = _delay(attributes, 'wire_delay', path, number)
+                continue
+
+            match = _DEFAULTS.match(statement)
+            if match:
+                if match.group('kind') != 'graph':
+                    defaults[match.group('kind')].update(_parse_attributes(match.group('attributes'), {}))
+                continue
+
+            match = _NODE.match(statement)
+            if match:
+                index = node_index(_unquote(match.group('node')))
+                attributes = _parse_attributes(match.group('attributes'), {})
+                if 'component_delay' in attributes:
+                    component_delay[index] = _delay(attributes, 'component_delay', path, number)
+                continue
+
+            raise ValueError("{}:{}: unsupported statement {}".format(path, number, statement))
+
+    names = list(nodes)
+    for index, delay in enumerate(component_delay):
+        if delay is None:
+            raise ValueError("{}: node {} has no component_delay".format(path, names[index]))
+        component_delay[index] = int(delay)
+
+    src = [tail for (tail, head) in edges]
+    dst = [head for (tail, head) in edges]
+    return Circuit(component_delay, src, dst, list(edges.values()), names, graph_name or None)
+
+
+def _parse_attributes(attributes, defaults: dict):
+    """
+    :param attributes: the text between the brackets of a statement, None if there are no brackets
+    :param defaults: values of the attributes not set by the statement
+    :return: a dictionary with the attributes
+    """
+    values = dict(defaults)
+    if attributes:
+        values.update((_unquote(key), _unquote(value)) for key, value in _ATTRIBUTE.findall(attributes))
+    return values
+
+
+def _delay(attributes: dict, name: str, path: str, number: int):
+    """
+    :return: the attribute converted to int
+    """
+    try:
+        return int(attributes[name])
+    except (KeyError, ValueError):
+        raise ValueError("{}:{}: missing or invalid {}".format(path, number, name))
+
+
+def _unquote(value: str):
+    if value.startswith('"') and value.endswith('"'):
+        return value[1:-1].replace('\\"', '"')
+    return value
+
+
+def write_dot(circuit: Circuit, path: str, chunk=1 << 16, labels=False):
+    """
+    Write the circuit as a strict digraph readable by read_circuit and by pygraphviz, a chunk of lines at a time, so
+    that no graph is built in memory. The nodes come first, in order, so read_circuit numbers them as the circuit
+    :param circuit:
+    :param path:
+    :param chunk: number of lines formatted at once
+    :param labels: also write what networkx writes for a graph of the retimer: the labels drawn by graphviz,
+    "name;component_delay" on the nodes and the wire_delay on the edges, and the name as "original-id"
+    :return: void
+    """
+    names = [_quote(str(name)) for name in circuit.names] if circuit.names is not None else None
+    node_format = '\t{0}\t [component_delay={1}];\n'
+    edge_format = '\t{0} -> {1}\t [wire_delay={2}];\n'
+    if labels is True:
+        node_format = '\t{0}\t [component_delay={1}, label={2}, "original-id"={0}];\n'
+        edge_format = '\t{0} -> {1}\t [label={2}, wire_delay={2}];\n'
+    with open(path, 'w') as dot:
+        if circuit.name is not None:
+            dot.write('strict digraph {0} {{\n\tgraph [name={0}];\n'.format(_quote(str(circuit.name))))
+        else:
+            dot.write('strict digraph "" {\n')
+        if labels is True:
+            dot.write('\tnode [label="\\N"];\n')
+        for start in range(0, len(circuit), chunk):
+            stop = min(start + chunk, len(circuit))
+            ids = names[start:stop] if names is not None else range(start, stop)
+            delays = circuit.component_delay[start:stop].tolist()
+            if labels is True:
+                raw = circuit.names[start:stop] if circuit.names is not None else range(start, stop)
+                texts = [_quote('{};{}'.format(name, delay)) for name, delay in zip(raw, delays)]
+            else:
+                texts = delays
+            dot.write(''.join(node_format.format(node, delay, text) for node, delay, text in zip(ids, delays, texts)))
+        for start in range(0, len(circuit.src), chunk):
+            src = circuit.src[start:start + chunk].tolist()
+            dst = circuit.dst[start:start + chunk].tolist()
+            wire_delay = circuit.wire_delay[start:start + chunk].tolist()
+            if names is not None:
+                src = [names[node] for node in src]
+                dst = [names[node] for node in dst]
+            dot.write(''.join(edge_format.format(v1, v2, delay) for v1, v2, delay in zip(src, dst, wire_delay)))
+        dot.write('}\n')
+
+
+def _quote(value: str):
+    if re.fullmatch(r'[\w.\-]+', value):
+        return value
+    return '"{}"'.format(value.replace('"', '\\"'))
@@ -0,0 +1,113 @@
+import json
+
+import numpy as np
+
+from src.circuit.circuit import Circuit
+from src.utils import dot
+
+# Formats of the retimed circuits
+DOT = 'dot'
+JSONL = 'jsonl'
+NPZ = 'npz'
+LAGS = 'lags'
+FORMATS = (DOT, JSONL, NPZ, LAGS)
+
+# Extension of each format, the lag-only files are .npz files too
+EXTENSIONS = {DOT: '.dot', JSONL: '.jsonl', NPZ: '.npz', LAGS: '.lags.npz'}
+
+
+def format_of(path: str):
+    """
+    :param path:
+    :return: the format given by the extension of the path, DOT for the unknown ones
+    """
+    for file_format in (LAGS, NPZ, JSONL):
+        if path.endswith(EXTENSIONS[file_format]):
+            return file_format
+    return DOT
+
+
+def export_retiming(circuit: Circuit, retimings, path: str, file_format=None, labels=True, chunk=1 << 16):
+    """
+    Write a retimed circuit in a single pass over its arrays, without building a graph:
+    - DOT: the retimed circuit as a strict digraph, with the graphviz labels if labels is set (see dot.write_dot)
+    - JSONL: a line with the sizes, then one line per node with its lag and one per edge with its registers
+    - NPZ: the retimed circuit as written by Circuit.save
+    - LAGS: only the lag of each node and the edges whose registers changed, see write_lags
+    :param circuit: the circuit before the retiming
+    :param retimings: lag of each node
+    :param path:
+    :param file_format: one of FORMATS, given by the extension of the path if None
+    :param labels: write the labels of the DOT format
+    :param chunk: number of lines formatted at once by the text formats
+    :return: void
+    """
+    retimings = np.asarray(retimings, dtype=np.int64)
+    file_format = file_format if file_format is not None else format_of(path)
+    if file_format == LAGS:
+        write_lags(circuit, retimings, path)
+    elif file_format == NPZ:
+        circuit.retime(retimings).save(path)
+    elif file_format == JSONL:
+        write_jsonl(circuit, retimings, path, chunk)
+    elif file_format == DOT:
+        dot.write_dot(circuit.retime(retimings), path, chunk, labels)
+    else:
+        raise ValueError("Unknown format {}, expected one of {}".format(file_format, ', '.join(FORMATS)))
+
+
+def write_jsonl(circuit: Circuit, retimings: np.ndarray, path: str, chunk=1 << 16):
+    """
+    Write the retimed circuit as JSON lines: {"nodes": n, "edges": m} first, then {"node", "component_delay", "lag"}
+    for each node in order and {"src", "dst", "wire_delay"} for each edge, with the retimed wire delay. Nodes are
+    given by name, or by index if the circuit has no names
+    :param circuit: the circuit before the retiming
+    :param retimings: lag of each node
+    :param path:
+    :param chunk: number of lines formatted at once
+    :return: void
+    """
+    names = [str(name) for name in circuit.names] if circuit.names is not None else None
+    with open(path, 'w') as lines:
+        lines.write(json.dumps({'nodes': len(circuit), 'edges': len(circuit.src)}) + '\n')
+        for start in range(0, len(circuit), chunk):
+            stop = min(start + chunk, len(circuit))
+            ids = names[start:stop] if names is not None else range(start, stop)
+            lines.write(''.join(json.dumps({'node': node, 'component_delay': delay, 'lag': lag}) + '\n'
+                                for node, delay, lag in zip(ids, circuit.component_delay[start:stop].tolist(),
+                                                            retimings[start:stop].tolist())))
+        for start in range(0, len(circuit.src), chunk):
+            src = circuit.src[start:start + chunk]
+            dst = circuit.dst[start:start + chunk]
+            wire_delay = (circuit.wire_delay[start:start + chunk] + retimings[dst] - retimings[src]).tolist()
+            src, dst = src.tolist(), dst.tolist()
+            if names is not None:
+                src = [names[node] for node in src]
+                dst = [names[node] for node in dst]
+            lines.write(''.join(json.dumps({'src': v1, 'dst': v2, 'wire_delay': delay}) + '\n'
+                                for v1, v2, delay in zip(src, dst, wire_delay)))
+
+
+def write_lags(circuit: Circuit, retimings: np.ndarray, path: str):
+    """
+    Write only what the retiming changes, as an uncompressed .npz file: the lag of each node ("retimings") and, for
+    each edge whose registers changed, its nodes ("src", "dst") and the registers added, negative if removed
+    ("delta"). Applied to the original circuit they give the retimed one
+    :param circuit: the circuit before the retiming
+    :param retimings: lag of each node
+    :param path:
+    :return: void
+    """
+    delta = retimings[circuit.dst] - retimings[circuit.src]
+    changed = np.flatnonzero(delta)
+    with open(path, 'wb') as file:
+        np.savez(file, retimings=retimings, src=circuit.src[changed], dst=circuit.dst[changed], delta=delta[changed])
+
+
+def read_lags(path: str):
+    """
+    :param path: a file written by write_lags
+    :return: the lags and the src, dst and delta of the edges whose registers changed
+    """
+    with np.load(path) as data:
+        return data['retimings'], data['src'], data['dst'], data['delta']
@@ -3,6 +3,8 @@ import networkx as nx
 import numpy.random as rnd
 import numpy as np
 
+from src.circuit.circuit import Circuit
+
 
 def generate_from_correlator(nodes: int):
     """
@@ -72,7 +74,7 @@ def random_generator(n: int, k: int, alpha: int, graph_version: int):
 
     print(len(graph.edges))
     for node in graph.nodes:
-        incoming = [(v1, v2) for (v1, v2) in graph.in_edges if v2 == node]
+        incoming = list(graph.in_edges(node))
         deleted_nodes = 0
         # Randomly decide if an edge has to be kept or discarded
         for edge in incoming:
@@ -118,5 +120,97 @@ def performance_generator(n: int):
     nx.nx_agraph.write_dot(graph, path + 'clean/perf-{}.dot'.format(str(n)))
 
 
+def correlator_circuit(nodes: int) -> Circuit:
+    """
+    Array version of generate_from_correlator: the same schema, built in O(nodes)
+    :param nodes: the desidered number of nodes in the circuit, nodes + 2 are generated
+    :return: the circuit
+    """
+    # the chain of the 3 delay components (down) and the one of the 7 delay components (up)
+    down = np.concatenate(([1], np.arange(3, nodes, 2)))
+    up = down + 1
+    last = up[-1] + 1
+    component_delay = np.full(last + 1, 3)
+    component_delay[up] = 7
+    component_delay[last] = 7
+
+    src = np.concatenate(([0, 2], down, down[:-1], up[1:], [down[-1], last]))
+    dst = np.concatenate(([1, 0], up, down[1:], up[:-1], [last, up[-1]]))
+    wire_delay = np.concatenate(([1, 0], np.zeros(len(down)), np.ones(len(down) - 1), np.zeros(len(up) - 1),
+                                 [1, 0]))
+    return Circuit(component_delay, src, dst, wire_delay)
+
+
+def path_circuit(n: int, component_delay=3, wire_delay=1) -> Circuit:
+    """
+    Array version of performance_generator: a ring of n nodes
+    :param n: the graph size
+    :param component_delay: delay of every node
+    :param wire_delay: registers on every edge
+    :return: the circuit
+    """
+    nodes = np.arange(n)
+    return Circuit(np.full(n, component_delay), nodes, (nodes + 1) % n, np.full(n, wire_delay))
+
+
+def random_k_out_circuit(n: int, k: int, seed=None, component_delay=3, wire_delay=1) -> Circuit:
+    """
+    Array version of random_generator, built in O(n * k): every node gets k edges towards nodes drawn uniformly
+    (without the preferential attachment of networkx), the repeated edges and the pairs of opposite edges are
+    dropped, then the first node is linked to the last one and every node to the first one.
+    :param n: number of nodes
+    :param k: edges drawn from each node
+    :param seed: seed of the random generator
+    :param component_delay: delay of every node
+    :param wire_delay: registers on every edge
+    :return: the circuit
+    """
+    generator = rnd.default_rng(seed)
+    src = np.repeat(np.arange(n, dtype=np.int64), k)
+    dst = generator.integers(0, n - 1, size=n * k)
+    # skip the source itself to avoid self loops
+    dst += dst >= src
+
+    keys = np.unique(src * n + dst)
+    keys = keys[~np.isin((keys % n) * n + keys // n, keys)]
+    keys = np.union1d(keys, np.concatenate(([n - 1], np.arange(1, n) * n)))
+    return Circuit(np.full(n, component_delay), keys // n, keys % n, np.full(len(keys), wire_delay))
+
+
+def randomize_registers(circuit: Circuit, seed=None) -> Circuit:
+    """
+    Array version of utilities.node_randomizer, in O(V + E): each node, in order, moves the minimum number of
+    registers of its incoming edges to its outgoing ones or the other way round, as the coin says. This is a
+    legal retiming, so the minimum clock does not change.
+    :param circuit:
+    :param seed: seed of the random generator
+    :return: the circuit with the registers moved
+    """
+    generator = rnd.default_rng(seed)
+    backward = generator.integers(0, 2, size=len(circuit)).tolist()
+    wire_delay = circuit.wire_delay.tolist()
+    out_offsets = circuit.out_offsets.tolist()
+    in_offsets = circuit.in_offsets.tolist()
+    in_edges = circuit.in_edges.tolist()
+
+    retimings = [0] * len(circuit)
+
+    for node in range(len(circuit)):
+        outgoing = range(out_offsets[node], out_offsets[node + 1])
+        incoming = in_edges[in_offsets[node]:in_offsets[node + 1]]
+        taken, given = (incoming, outgoing) if backward[node] else (outgoing, incoming)
+        if not taken:
+            continue
+        moved = min(wire_delay[edge] for edge in taken)
+        if moved > 0:
+            for edge in taken:
+                wire_delay[edge] -= moved
+            for edge in given:
+                wire_delay[edge] += moved
+            retimings[node] = -moved if backward[node] else moved
+
+    return circuit.retime(np.asarray(retimings, dtype=np.int64))
+
+
 if __name__ == '__main__':
     random_generator(n=500, k=100, alpha=4000, graph_version=1)
@@ -1,12 +1,57 @@
-import networkx as nx
-import numpy as np
+from __future__ import annotations
+
+import os
+from typing import TYPE_CHECKING
+
 import numpy.random as rnd
 
+from src.circuit.circuit import Circuit
+from src.utils import dot
+
+# the graph functions import networkx (and pygraphviz through it) when called, loading a circuit needs neither
+if TYPE_CHECKING:
+    import networkx as nx
+
 
 def load_graph(path: str) -> nx.DiGraph:
+    import networkx as nx
+
     return nx.nx_agraph.read_dot(path)
 
 
+def save_circuit(circuit: Circuit, path: str):
+    """
+    Write a circuit straight to disk, as .npz (see Circuit.save) or else as .dot with the streaming writer
+    :param circuit:
+    :param path:
+    :return: void
+    """
+    if path.endswith('.npz'):
+        circuit.save(path)
+    else:
+        dot.write_dot(circuit, path)
+
+
+def load_circuit(path: str, cache=False) -> Circuit:
+    """
+    Load a circuit from a .dot file with the streaming parser, or from a .npz file written by Circuit.save
+    :param path:
+    :param cache: keep a .npz copy next to the .dot file and read it instead as long as it is newer
+    :return: the circuit
+    """
+    if path.endswith('.npz'):
+        return Circuit.load(path)
+
+    cached = os.path.splitext(path)[0] + '.npz'
+    if cache is True and os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(path):
+        return Circuit.load(cached)
+
+    circuit = dot.read_circuit(path)
+    if cache is True:
+        circuit.save(cached)
+    return circuit
+
+
 def node_randomizer(graph: nx.DiGraph) -> nx.DiGraph:
     """
     Randomize a graph moving forward or backward the registers among the arcs. This is done in a
@@ -18,8 +63,7 @@ def node_randomizer(graph: nx.DiGraph) -> nx.DiGraph:
     :return:
     """
     for node in graph.nodes:
-        keep = np.average(rnd.binomial(1, 0.5, 1000))
-        if keep < 0.5:
+        if rnd.randint(2) == 0:
             pick_from_back(graph, node)
         else:
             pick_from_front(graph, node)
@@ -31,16 +75,18 @@ def pick_from_back(graph: nx.DiGraph, node: str):
     Move from node's incoming arc to outgoing arc the common minimum edge number.
     Do nothing if there is an arc with zero registers
     """
-    arcs = [weight['wire_delay'] for (v1, v2, weight) in graph.edges.data() if v2 == node]
+    import networkx as nx
+
+    arcs = [weight['wire_delay'] for (v1, v2, weight) in graph.in_edges(node, data=True)]
     if arcs:
         min_registers = min(arcs)
         if min_registers and min_registers > 0:
             nx.set_edge_attributes(graph,
                                    {(v1, v2): {'wire_delay': weight['wire_delay'] - min_registers} for (v1, v2, weight) in
-                                    graph.edges.data() if v2 == node})
+                                    graph.in_edges(node, data=True)})
             nx.set_edge_attributes(graph,
                                    {(v1, v2): {'wire_delay': weight['wire_delay'] + min_registers} for (v1, v2, weight) in
-                                    graph.edges.data() if v1 == node})
+                                    graph.out_edges(node, data=True)})
 
 
 def pick_from_front(graph: nx.DiGraph, node: str):
@@ -48,13 +94,15 @@ def pick_from_front(graph: nx.DiGraph, node: str):
     Move from node's outgoing arcs to incoming arc the common minimum edge number
     Do nothing if there is an arc with zero registers
     """
-    arcs =[weight['wire_delay'] for (v1, v2, weight) in graph.edges.data() if v1 == node]
+    import networkx as nx
+
+    arcs = [weight['wire_delay'] for (v1, v2, weight) in graph.out_edges(node, data=True)]
     if arcs:
         min_registers = min(arcs)
         if min_registers and min_registers > 0:
             nx.set_edge_attributes(graph,
                                    {(v1, v2): {'wire_delay': weight['wire_delay'] - min_registers} for (v1, v2, weight) in
-                                    graph.edges.data() if v1 == node})
+                                    graph.out_edges(node, data=True)})
             nx.set_edge_attributes(graph,
                                    {(v1, v2): {'wire_delay': weight['wire_delay'] + min_registers} for (v1, v2, weight) in
-                                    graph.edges.data() if v2 == node})
+                                    graph.in_edges(node, data=True)})
@@ -1,130 +1,713 @@
-from functools import reduce
+import heapq
+import os
+import shutil
+import tempfile
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
-import networkx as nx
 import numpy as np
 
+from src.circuit.circuit import COMPONENT_DELAY, Circuit
+from src.instrument.instrument import APSP, COMPUTE_WD, WEIGHT_EDGES, Instrument
+
+DIJKSTRA = 'dijkstra'
+FLOYD_WARSHALL = 'floyd-warshall'
+PARALLEL = 'parallel'
+ENGINES = [DIJKSTRA, FLOYD_WARSHALL, PARALLEL]
+
+# Upper bound on the number of elements of the temporary arrays used by the blocked Floyd Warshall
+_BLOCK_ELEMENTS = 1 << 21
+
+# Number of elements of a tile of rows of W and D
+_TILE_ELEMENTS = 1 << 22
+
 
 class WD:
     """
     Class responsible of executing the WD algorithm on a graph
     """
 
-    def __init__(self, graph: nx.DiGraph, print_wd=False):
-        self._graph = graph
-        self._weighted_graph = nx.DiGraph()
-        self._matrix_dimension = len(graph)
+    def __init__(self, circuit: Circuit, print_wd=False, engine=DIJKSTRA, block_size=64, jobs=None,
+                 memmap_dir=None, sparse=False):
+        if engine not in ENGINES:
+            raise ValueError("Unknown WD engine {}".format(engine))
+        if engine == FLOYD_WARSHALL and (memmap_dir is not None or sparse is True):
+            raise ValueError("The {} engine needs W and D in memory".format(engine))
+        if sparse is True and memmap_dir is not None:
+            raise ValueError("The sparse mode does not store W and D")
+        self._circuit = circuit
+        self._matrix_dimension = len(circuit)
         self.w = None
         self.d = None
-        self.component_delay = 'component_delay'
-        self.wire_delay = 'wire_delay'
-        self.weight = 'weight'
+        self.pairs = None
         self.print_wd = print_wd
+        self.engine = engine
+        self.block_size = block_size
+        self.jobs = jobs or os.cpu_count()
+        self.memmap_dir = memmap_dir
+        # subdirectory of memmap_dir holding the files of this instance only, removed with it unless keep_files
+        self.memmap_path = None
+        self._memmap_files = {}
+        self._remove_files = None
+        self.sparse = sparse
+        # entry of the persistent cache of the circuit, if any
+        self.cache = None
+        self.instrument = Instrument()
 
     def wd(self):
         """
         Executes the three steps of the WD algorithm
         :return: Matrices W and D
         """
-        self._weight_edges()
-        self._all_pairs_shortest_path()
-        self._compute_wd()
+        if self.cache is None or self._load_cached() is False:
+            instrument = self.instrument
+            nodes = self._matrix_dimension
+            with instrument.phase(WEIGHT_EDGES, nodes=nodes):
+                self._weight_edges()
+            if self.sparse is True:
+                with instrument.phase(APSP, nodes=nodes, engine=self.engine, sparse=True):
+                    self._sparse_pairs()
+            else:
+                with instrument.phase(APSP, nodes=nodes, engine=self.engine, sparse=False):
+                    self._all_pairs_shortest_path()
+                with instrument.phase(COMPUTE_WD, nodes=nodes):
+                    self._compute_wd()
+            if self.cache is not None:
+                self._save_cached()
 
         if self.print_wd is True:
             self.print_matrices()
 
+    def update(self, circuit: Circuit, edits):
+        """
+        Move W and D to an edited version of the circuit, one edit at a time. The edits that can only make paths
+        better (higher delay, fewer registers, new edge) are applied exactly to the pairs whose paths can go through
+        the edited element, without any search. The other ones search again only from the sources having a pair whose
+        best path goes through it. In sparse mode, or if the matrices do not exist yet, everything is computed again.
+        :param circuit: the circuit with the edits applied
+        :param edits: the edits, as passed to Circuit.edit
+        :return: the number of rows searched again
+        """
+        circuits = [self._circuit]
+        for edit in edits:
+            circuits.append(circuits[-1].edit([edit]))
+        for edited in circuits[1:]:
+            edited.topological_order()
+
+        if self.w is None or self.sparse is True or self._wider_dtype(circuits[1:]):
+            self._circuit = circuit
+            self.w, self.d, self.pairs = None, None, None
+            self.wd()
+            return self._matrix_dimension
+
+        if not (self.w.flags.writeable and self.d.flags.writeable):
+            self.w = self._writable_copy(self.w, 'w')
+            self.d = self._writable_copy(self.d, 'd')
+
+        searched = 0
+        for edit, edited in zip(edits, circuits[1:]):
+            rows = self._apply_edit(edit, edited)
+            self._circuit = edited
+            if rows.size > 0:
+                with self.instrument.phase(WEIGHT_EDGES, nodes=self._matrix_dimension):
+                    self._weight_edges()
+                with self.instrument.phase(APSP, nodes=self._matrix_dimension, engine=DIJKSTRA, rows=rows.size):
+                    self._search_rows(rows)
+                searched += rows.size
+
+        self._circuit = circuit
+        self._weight_edges()
+        if self.cache is not None:
+            self._save_cached()
+        return searched
+
+    def _wider_dtype(self, circuits: list):
+        """
+        :param circuits:
+        :return: if the values of any of the circuits may not fit the type of W and D
+        """
+        if self.memmap_dir is None:
+            return False
+        bound = max(max(int(np.sum(circuit.wire_delay)), int(np.sum(circuit.component_delay)) + 1)
+                    for circuit in circuits)
+        return narrowest_dtype(bound).itemsize > self.w.dtype.itemsize
+
+    def _apply_edit(self, edit, edited: Circuit):
+        """
+        Update W and D for a single edit. A path goes through a node x (or an edge u -> v) with the minimum w and the
+        maximum d exactly when joining the best paths s -> x and x -> t (s -> u, the edge and v -> t) gives back
+        W(s,t) and D(s,t), so the pairs involved are found comparing the matrices with the joined paths.
+        :param edit: an edit, as passed to Circuit.edit
+        :param edited: the circuit with the edit applied
+        :return: the sources that have to be searched again
+        """
+        circuit = self._circuit
+        if edit[0] == COMPONENT_DELAY:
+            x = edit[1]
+            before, after = int(circuit.component_delay[x]), int(edit[2])
+            sources = np.nonzero(circuit.reaching([x]))[0]
+            targets = np.nonzero(circuit.reachable([x]))[0]
+            # the left part leaves the delay of x to the right one
+            left_w, left_d = self.w[sources, x], self.d[sources, x].astype(np.int64) - before
+            right_w, right_d = self.w[x, targets], self.d[x, targets]
+            if after > before:
+                return self._join(sources, targets, left_w, left_d + after - before, right_w, right_d)
+
+            rows = self._tight_sources(sources, targets, left_w, left_d, right_w, right_d, exclude=x)
+            # every path to x or from x goes through x
+            self.d[sources, x] -= before - after
+            self.d[x, targets] -= before - after
+            self.d[x, x] = after
+            return rows
+
+        v1, v2 = edit[1], edit[2]
+        edge = circuit.edge_index(v1, v2)
+        before = int(circuit.wire_delay[edge]) if edge is not None else None
+        after = edit[3] if len(edit) > 3 else None
+        sources = np.nonzero(circuit.reaching([v1]))[0]
+        targets = np.nonzero(circuit.reachable([v2]))[0]
+        left_w, left_d = self.w[sources, v1], self.d[sources, v1]
+        right_w, right_d = self.w[v2, targets], self.d[v2, targets]
+
+        if before is not None and (after is None or after > before):
+            return self._tight_sources(sources, targets, left_w.astype(np.int64) + before, left_d, right_w, right_d)
+        if after is not None and (before is None or after < before):
+            return self._join(sources, targets, left_w.astype(np.int64) + after, left_d, right_w, right_d)
+        return np.empty(0, dtype=np.int64)
+
+    def _join(self, sources, targets, left_w, left_d, right_w, right_d):
+        """
+        Improve every pair (s,t) with the path made of the left part s -> x and the right part x -> t, if better.
+        A pair stored as W = D = 0 may be unreachable or reachable with no register and no delay: if the joined
+        path has registers the two cases disagree, so its source is searched again.
+        :return: the sources that have to be searched again
+        """
+        ambiguous = []
+        for start, tile in _index_tiles(sources, len(targets)):
+            rows = np.ix_(tile, targets)
+            current_w = self.w[rows].astype(np.int64)
+            current_d = self.d[rows].astype(np.int64)
+            joined_w = left_w[start:start + len(tile), None] + right_w[None, :]
+            joined_d = left_d[start:start + len(tile), None] + right_d[None, :]
+
+            unknown = (current_w == 0) & (current_d == 0) & (tile[:, None] != targets[None, :])
+            better = (joined_w < current_w) | ((joined_w == current_w) & (joined_d > current_d))
+            better |= unknown & (joined_w > 0)
+            ambiguous.append(tile[np.any(unknown & (joined_w > 0), axis=1)])
+
+            self.w[rows] = np.where(better, joined_w, current_w)
+            self.d[rows] = np.where(better, joined_d, current_d)
+
+        return np.concatenate(ambiguous) if ambiguous else np.empty(0, dtype=np.int64)
+
+    def _tight_sources(self, sources, targets, left_w, left_d, right_w, right_d, exclude=None):
+        """
+        :param exclude: a node whose pairs are updated apart
+        :return: the sources with a pair (s,t) whose best path is made of the left part s -> x and the right part
+        x -> t
+        """
+        tight = []
+        for start, tile in _index_tiles(sources, len(targets)):
+            rows = np.ix_(tile, targets)
+            joined_w = left_w[start:start + len(tile), None] + right_w[None, :]
+            joined_d = left_d[start:start + len(tile), None] + right_d[None, :]
+            through = (joined_w == self.w[rows]) & (joined_d == self.d[rows])
+            if exclude is not None:
+                through &= (tile[:, None] != exclude) & (targets[None, :] != exclude)
+            tight.append(tile[np.any(through, axis=1)])
+
+        return np.concatenate(tight) if tight else np.empty(0, dtype=np.int64)
+
+    def _search_rows(self, rows):
+        """
+        Run the single source search from the given nodes and overwrite their rows of W and D
+        :param rows: the sources
+        :return: void
+        """
+        component_delay = self._circuit.component_delay
+        for src in rows.tolist():
+            dist_w, dist_d = self._single_source_shortest_path(src)
+            targets = np.fromiter(dist_w.keys(), dtype=np.int64, count=len(dist_w))
+            row_w = np.zeros(self._matrix_dimension, dtype=self.w.dtype)
+            row_d = np.zeros(self._matrix_dimension, dtype=self.d.dtype)
+            row_w[targets] = np.fromiter(dist_w.values(), dtype=np.int64, count=len(dist_w))
+            row_d[targets] = np.fromiter(dist_d.values(), dtype=np.int64, count=len(dist_d)) + component_delay[targets]
+            self.w[src] = row_w
+            self.d[src] = row_d
+
+    def _load_cached(self):
+        """
+        Read W and D, or the sparse pairs, from the cache. In out-of-core mode the matrices are mapped read-only.
+        :return: if they were cached
+        """
+        if self.sparse is True:
+            arrays = [self.cache.load('pairs-' + name) for name in ('sources', 'targets', 'w', 'd')]
+            if any(array is None for array in arrays):
+                return False
+            self.pairs = SparseWD(*arrays, int(np.max(self._circuit.component_delay)))
+            return True
+
+        mmap_mode = 'r' if self.memmap_dir is not None else None
+        w = self.cache.load('w', mmap_mode)
+        d = self.cache.load('d', mmap_mode)
+        if w is None or d is None:
+            return False
+        self.w = w
+        self.d = d
+        return True
+
+    def _save_cached(self):
+        """
+        Store W and D, or the sparse pairs, in the cache
+        """
+        if self.sparse is True:
+            for name in ('sources', 'targets', 'w', 'd'):
+                self.cache.save('pairs-' + name, getattr(self.pairs, name))
+        else:
+            self.cache.save('w', self.w)
+            self.cache.save('d', self.d)
+
     def _weight_edges(self):
         """
         Weight the edge with (w, -d) where:
         - w: Arc cost
         - d: Logic component delay
+        The edges without registers form a DAG, so the topological rank of the nodes is stored as well: among the
+        nodes at the same register distance it tells which ones have to be settled first.
         """
+        circuit = self._circuit
+        self._out_offsets = circuit.out_offsets.tolist()
+        self._dst = circuit.dst.tolist()
+        self._edge_w = circuit.wire_delay.tolist()
+        self._edge_d = circuit.component_delay[circuit.src].tolist()
+        self._rank = [0] * len(circuit)
+        for (rank, node) in enumerate(circuit.topological_order()):
+            self._rank[node] = rank
 
-        component_delay = nx.get_node_attributes(G=self._graph, name=self.component_delay)
+        # Scalar version of (w, -d): w * K - d with K greater than the delay of any simple path, so the comparison
+        # is done first on w and then on d. Since every cycle has at least one register no cycle is negative.
+        self._scale = int(np.sum(circuit.component_delay)) + 1
+        self._encoded_weight = circuit.wire_delay * self._scale - circuit.component_delay[circuit.src]
 
-        # Used in _custom_weight function(). Get the highest gate delay
-        self._max_component_delay = max([d for (node, d) in component_delay.items()])
+        # No simple path has more registers or more delay than the whole circuit
+        if self.memmap_dir is None:
+            self._dtype = np.dtype(int)
+        else:
+            self._dtype = narrowest_dtype(max(int(np.sum(circuit.wire_delay)), self._scale))
 
-        node_attributes = {node: d for (node, d) in component_delay.items()}
+    def _single_source_shortest_path(self, source: int):
+        """
+        Dijkstra algorithm on the lexicographic weight (w, -d). The nodes are extracted by (w, topological rank) so
+        a node is settled only after all its predecessors on the paths with the minimum w: at that time the highest
+        d among those paths is already known. Only the distances are kept, no path is stored.
+        :param source:
+        :return: two dicts with the sum of w and the sum of d (target excluded) of each reachable node
+        """
+        out_offsets = self._out_offsets
+        dst = self._dst
+        edge_w = self._edge_w
+        edge_d = self._edge_d
+        rank = self._rank
 
-        # Change the component delay sign (-d)
-        component_delay = {node: -1 * d for (node, d) in node_attributes.items()}
+        dist_w = {source: 0}
+        dist_d = {source: 0}
+        settled = set()
+        heap = [(0, rank[source], source)]
 
-        # Add nodes and import attributes for d computation
-        self._weighted_graph.add_nodes_from(self._graph.nodes())
-        nx.set_node_attributes(G=self._weighted_graph, values=node_attributes, name=self.component_delay)
+        while heap:
+            w_u, _, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            settled.add(u)
+            d_u = dist_d[u]
+            for edge in range(out_offsets[u], out_offsets[u + 1]):
+                v = dst[edge]
+                w_v = w_u + edge_w[edge]
+                d_v = d_u + edge_d[edge]
+                if v not in dist_w or w_v < dist_w[v]:
+                    dist_w[v] = w_v
+                    dist_d[v] = d_v
+                    heapq.heappush(heap, (w_v, rank[v], v))
+                elif w_v == dist_w[v] and d_v > dist_d[v]:
+                    dist_d[v] = d_v
 
-        # Get wire delay (w)
-        wire_delay = nx.get_edge_attributes(G=self._graph, name=self.wire_delay)
-        # Create the weight (w,-d)
-        weights = {(v1, v2): (wire_delay, component_delay[v1]) for ((v1, v2), wire_delay) in wire_delay.items()}
-        self._weighted_graph.add_edges_from(weights)
-        nx.set_edge_attributes(G=self._weighted_graph, values=weights, name=self.weight)
+        return dist_w, dist_d
 
-    def _custom_weight(self, attributes):
+    def _all_pairs_shortest_path(self):
         """
-        Define a new weight by combining w and -d using the maximum value of d in order to prioritize the comparison
-        first on w  (pick the lowest) and then on d (pick the highest one since the original comparison is done with -d).
-        Formula w * max(all component delays) + max(all component delays) + (-d)
-        :param attributes:
-        :return:
+        Resolve an all pair shortest path problem with the selected engine
         """
-        return attributes[self.weight][0] * self._max_component_delay + (
-                self._max_component_delay + attributes[self.weight][1])
+        if self.engine == FLOYD_WARSHALL:
+            self._floyd_warshall()
+        elif self.engine == PARALLEL:
+            self._parallel_dijkstra()
+        else:
+            self._dijkstra()
 
-    def _all_pairs_shortest_path(self):
+    def _dijkstra(self):
         """
-        Resolve an all pair shortest path problem
+        Run the single source search from every node, one tile of sources at a time. Unreachable pairs are marked
+        with -1 in W.
         """
-        self.all_pairs = dict(nx.all_pairs_dijkstra_path(G=self._weighted_graph,
-                                                         weight=lambda v1, v2, attributes: self._custom_weight(
-                                                             attributes)))
+        w = self._allocate('w')
+        d = self._allocate('d')
 
-    def _compute_wd(self):
-        mat_dim = self._matrix_dimension
-        w = np.zeros((mat_dim, mat_dim), dtype=int)
-        d = np.zeros((mat_dim, mat_dim), dtype=int)
-        compute_w = self._compute_w
-        compute_d = self._compute_d
-
-        for (src, targets) in self.all_pairs.items():
-            for (target, path) in targets.items():
-                # add also the source node to compute the total w and d
-                path.insert(0, src)
-                w[int(src)][int(target)] = compute_w(path)
-                d[int(src)][int(target)] = compute_d(path)
+        for start, tile in row_tiles(w):
+            self._search_tile(start, start + len(tile), w, d)
 
         self.w = w
         self.d = d
 
-    def _compute_w(self, path: list):
+    def _allocate(self, name: str, dtype=None):
+        """
+        Allocate a V x V matrix, in memory or as a memory-mapped .npy file inside memmap_path. Each allocation gets a
+        new file, so the matrices still mapped by someone else, e.g. OPT or the cache, are never truncated: the
+        previous file of the same matrix is only unlinked, and its mappings stay valid
+        :param name: name of the matrix
+        :param dtype: type of the values, the narrowest one for the circuit if None
+        :return: the matrix, not initialized
+        """
+        shape = (self._matrix_dimension, self._matrix_dimension)
+        dtype = dtype if dtype is not None else self._dtype
+        if self.memmap_dir is None:
+            return np.empty(shape, dtype=dtype)
+        if self.memmap_path is None:
+            os.makedirs(self.memmap_dir, exist_ok=True)
+            self.memmap_path = tempfile.mkdtemp(prefix='wd-', dir=self.memmap_dir)
+            self._remove_files = weakref.finalize(self, shutil.rmtree, self.memmap_path, True)
+        descriptor, path = tempfile.mkstemp(prefix=name + '-', suffix='.npy', dir=self.memmap_path)
+        os.close(descriptor)
+        matrix = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+        previous = self._memmap_files.get(name)
+        if previous is not None and os.path.exists(previous):
+            os.remove(previous)
+        self._memmap_files[name] = path
+        return matrix
+
+    def _writable_copy(self, matrix: np.ndarray, name: str):
+        """
+        :return: a writable copy of a read-only matrix, e.g. one mapped from the cache, memory-mapped in out-of-core
+        mode so that it is never loaded in memory as a whole
+        """
+        if self.memmap_dir is None:
+            return np.array(matrix)
+        copy = self._allocate(name, matrix.dtype)
+        for start, tile in row_tiles(matrix):
+            copy[start:start + len(tile)] = tile
+        copy.flush()
+        return copy
+
+    def keep_files(self):
+        """
+        Leave the memory-mapped files of W and D on disk when this instance is collected, e.g. to open them from
+        another process. Removing memmap_path is then up to the caller
+        :return: void
+        """
+        if self._remove_files is not None:
+            self._remove_files.detach()
+
+    def _search_tile(self, start: int, stop: int, w: np.ndarray, d: np.ndarray):
+        """
+        Run the single source search from the nodes start..stop - 1 and write their rows of W and D
+        :param w: matrix receiving the sum of w, -1 for the unreachable nodes
+        :param d: matrix receiving the sum of d, target excluded
+        :return: void
+        """
+        tile_w = np.full((stop - start, self._matrix_dimension), -1, dtype=w.dtype)
+        tile_d = np.zeros((stop - start, self._matrix_dimension), dtype=d.dtype)
+
+        for src in range(start, stop):
+            dist_w, dist_d = self._single_source_shortest_path(src)
+            targets = list(dist_w.keys())
+            tile_w[src - start, targets] = list(dist_w.values())
+            tile_d[src - start, targets] = list(dist_d.values())
+
+        w[start:stop] = tile_w
+        d[start:stop] = tile_d
+
+    def _search_pairs(self, start: int, stop: int, floor: int):
+        """
+        Run the single source search from the nodes start..stop - 1 and keep only the pairs with D(u,v) > floor
+        :return: sources, targets, W and D of the pairs kept
+        """
+        component_delay = self._circuit.component_delay
+        sources, targets, w, d = [], [], [], []
+
+        for src in range(start, stop):
+            dist_w, dist_d = self._single_source_shortest_path(src)
+            reached = np.fromiter(dist_w.keys(), dtype=np.int64, count=len(dist_w))
+            reached_d = np.fromiter(dist_d.values(), dtype=np.int64, count=len(dist_d)) + component_delay[reached]
+            relevant = reached_d > floor
+            sources.append(np.full(np.count_nonzero(relevant), src, dtype=np.int64))
+            targets.append(reached[relevant])
+            w.append(np.fromiter(dist_w.values(), dtype=np.int64, count=len(dist_w))[relevant])
+            d.append(reached_d[relevant])
+
+        return [np.concatenate(values) if values else np.empty(0, dtype=np.int64)
+                for values in (sources, targets, w, d)]
+
+    def _sparse_pairs(self):
         """
-        :param path: path from the source to the target node
-        :return: the sum all the wire delays along a path
+        Keep only the pairs that can give an OPT1 constraint, i.e. the ones with D(u,v) greater than the delay of
+        the slowest component (the lowest possible clock). The unreachable pairs are never stored.
         """
-        graph = self._weighted_graph
-        weight = self.weight
-        return sum([graph[v1][v2][weight][0] for v1, v2 in zip(path, path[1:])
-                    if v2 in graph[v1]])
+        mat_dim = self._matrix_dimension
+        floor = int(np.max(self._circuit.component_delay))
+        chunks = np.array_split(np.arange(mat_dim), min(mat_dim, 4 * self.jobs) or 1)
+        chunks = [(int(chunk[0]), int(chunk[-1]) + 1, floor) for chunk in chunks if chunk.size > 0]
+
+        if self.engine == PARALLEL:
+            with ProcessPoolExecutor(max_workers=self.jobs, initializer=_init_worker,
+                                     initargs=(self._circuit, None, False, self._dtype)) as pool:
+                results = list(pool.map(_search_worker_pairs, chunks))
+        else:
+            results = [self._search_pairs(*chunk) for chunk in chunks]
+
+        sources, targets, w, d = [np.concatenate(values) for values in zip(*results)]
+        self.pairs = SparseWD(sources, targets, w, d, floor)
+
+    def _parallel_dijkstra(self):
+        """
+        Split the sources among a pool of processes. Each worker writes its rows of W and D directly in two
+        matrices allocated in shared memory, which are copied back once all the searches are done. In out-of-core
+        mode the workers write directly in the memory-mapped files.
+        """
+        mat_dim = self._matrix_dimension
+        chunks = np.array_split(np.arange(mat_dim), min(mat_dim, 4 * self.jobs) or 1)
+        chunks = [(int(chunk[0]), int(chunk[-1]) + 1) for chunk in chunks if chunk.size > 0]
+
+        if self.memmap_dir is not None:
+            w = self._allocate('w')
+            d = self._allocate('d')
+            targets = (w.filename, d.filename)
+            self._run_workers(targets, chunks)
+            self.w = w
+            self.d = d
+            return
+
+        size = max(1, mat_dim * mat_dim * self._dtype.itemsize)
+        shared_w = shared_memory.SharedMemory(create=True, size=size)
+        shared_d = shared_memory.SharedMemory(create=True, size=size)
+        try:
+            self._run_workers((shared_w.name, shared_d.name), chunks)
+            w = np.ndarray((mat_dim, mat_dim), dtype=self._dtype, buffer=shared_w.buf)
+            d = np.ndarray((mat_dim, mat_dim), dtype=self._dtype, buffer=shared_d.buf)
+            self.w = w.copy()
+            self.d = d.copy()
+            del w, d
+        finally:
+            for shared in (shared_w, shared_d):
+                shared.close()
+                shared.unlink()
 
-    def _compute_d(self, path: list):
+    def _run_workers(self, targets: tuple, chunks: list):
         """
-        :param path: path from the source to the target node
-        :return: the sum all the gate delays along a path plus the target one's
+        :param targets: shared memory names or memory-mapped file paths of W and D
+        :param chunks: ranges of sources assigned to each task
+        :return: void
         """
-        target = path[-1]
-        graph = self._weighted_graph
-        weight = self.weight
-        component_delay = self.component_delay
-        return graph.nodes[target][component_delay] - sum(
-            [graph[v1][v2][weight][1] for v1, v2 in zip(path, path[1:])
-             if v2 in graph[v1]])
+        with ProcessPoolExecutor(max_workers=self.jobs, initializer=_init_worker,
+                                 initargs=(self._circuit, targets, self.memmap_dir is not None, self._dtype)) as pool:
+            list(pool.map(_search_worker_tile, chunks))
+
+    def _floyd_warshall(self):
+        """
+        Blocked Floyd Warshall on the scalar weight. For each block K of intermediate nodes:
+        1) close the paths inside K
+        2) extend the column panel dist[:, K] through the closure
+        3) update the whole matrix with the min-plus product of the column panel and the row panel dist[K, :]
+        Only the encoded distance is kept, W and D are decoded by _compute_wd.
+        """
+        mat_dim = self._matrix_dimension
+        circuit = self._circuit
+        infinity = np.iinfo(np.int64).max // 4
+
+        dist = np.full((mat_dim, mat_dim), infinity, dtype=np.int64)
+        dist[circuit.src, circuit.dst] = self._encoded_weight
+        np.fill_diagonal(dist, 0)
+
+        for start in range(0, mat_dim, self.block_size):
+            block = slice(start, min(start + self.block_size, mat_dim))
+
+            closure = dist[block, block].copy()
+            for k in range(closure.shape[0]):
+                np.minimum(closure, closure[:, k, None] + closure[None, k, :], out=closure)
+
+            _min_plus_update(dist[:, block], dist[:, block], closure)
+            _min_plus_update(dist, dist[:, block].copy(), dist[block, :].copy())
+
+        self._dist = dist
+        self._infinity = infinity
+
+    def _decode_distances(self):
+        """
+        Split the encoded distances in the sum of w and the sum of d (target excluded)
+        """
+        dist = self._dist
+        scale = self._scale
+        unreachable = dist >= self._infinity // 2
+
+        # w = ceil(dist / K), d = w * K - dist
+        w = -(-dist // scale)
+        dist *= -1
+        dist += w * scale
+        w[unreachable] = -1
+
+        self.w = w
+        self.d = dist
+        self._dist = None
+
+    def _compute_wd(self):
+        """
+        Add the target delay to D and set both W and D to 0 for the unreachable pairs
+        """
+        if self.engine == FLOYD_WARSHALL:
+            self._decode_distances()
+
+        component_delay = self._circuit.component_delay
+        for start, tile_w in row_tiles(self.w):
+            tile_d = self.d[start:start + len(tile_w)]
+            unreachable = tile_w < 0
+            tile_d += component_delay
+            tile_w[unreachable] = 0
+            tile_d[unreachable] = 0
+
+        if self.memmap_dir is not None:
+            self.w.flush()
+            self.d.flush()
 
     def print_matrices(self):
         """
         Print W and D matrices if the corresponding flag is passed to the object constructor
         :return:
         """
+        if self.pairs is not None:
+            print("W and D pairs")
+            print(self.pairs)
+            return
         print("W matrix")
         print(self.w)
         print("D matrix")
         print(self.d)
+
+
+class SparseWD:
+    """
+    The pairs (u,v) with D(u,v) > floor in coordinate format, sorted by D. With floor equal to the delay of the
+    slowest component these are the only pairs giving an OPT1 constraint.
+    """
+
+    def __init__(self, sources, targets, w, d, floor: int):
+        order = np.argsort(d, kind='stable')
+        self.sources = np.asarray(sources, dtype=np.int32)[order]
+        self.targets = np.asarray(targets, dtype=np.int32)[order]
+        self.w = np.asarray(w, dtype=np.int64)[order]
+        self.d = np.asarray(d, dtype=np.int64)[order]
+        self.floor = floor
+
+    def __len__(self):
+        return len(self.d)
+
+    def __repr__(self):
+        return "\n".join("({}, {}) W={} D={}".format(u, v, w, d)
+                         for u, v, w, d in zip(self.sources, self.targets, self.w, self.d))
+
+    def clocks(self):
+        """
+        :return: the candidate clocks, i.e. the floor and the distinct D values above it, sorted
+        """
+        return np.union1d([self.floor], self.d)
+
+
+# State of a worker process of the parallel engine, set by _init_worker
+_worker = {}
+
+
+def _init_worker(circuit: Circuit, targets: tuple, memmap: bool, dtype: np.dtype):
+    """
+    Attach the worker process to the W and D matrices and prepare the circuit weights
+    :param targets: shared memory names or memory-mapped file paths of W and D, None in sparse mode
+    :param memmap: whether targets are memory-mapped files
+    """
+    mat_dim = len(circuit)
+    engine = WD(circuit)
+    engine._weight_edges()
+    _worker['engine'] = engine
+    if targets is None:
+        return
+    if memmap:
+        _worker['matrices'] = [np.load(target, mmap_mode='r+') for target in targets]
+    else:
+        _worker['shared'] = [shared_memory.SharedMemory(name=target) for target in targets]
+        _worker['matrices'] = [np.ndarray((mat_dim, mat_dim), dtype=dtype, buffer=shared.buf)
+                               for shared in _worker['shared']]
+
+
+def _search_worker_tile(chunk: tuple):
+    """
+    Compute the rows of W and D of the sources chunk[0]..chunk[1] - 1 inside a worker process
+    """
+    w, d = _worker['matrices']
+    _worker['engine']._search_tile(chunk[0], chunk[1], w, d)
+    if isinstance(w, np.memmap):
+        w.flush()
+        d.flush()
+
+
+def _search_worker_pairs(chunk: tuple):
+    """
+    Compute the relevant pairs of the sources chunk[0]..chunk[1] - 1 inside a worker process
+    :param chunk: first source, last source + 1 and floor of D
+    """
+    return _worker['engine']._search_pairs(*chunk)
+
+
+def narrowest_dtype(bound: int):
+    """
+    :param bound: the highest absolute value to store
+    :return: the narrowest signed integer type able to hold the values between -bound and bound
+    """
+    for dtype in (np.int8, np.int16, np.int32):
+        if bound <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def row_tiles(matrix: np.ndarray, elements=_TILE_ELEMENTS):
+    """
+    Iterate over a matrix by tiles of rows, so a memory-mapped matrix is never loaded in memory as a whole
+    :param matrix:
+    :param elements: approximate number of elements of each tile
+    :return: generator of (first row, tile) pairs
+    """
+    rows = max(1, elements // max(1, matrix.shape[1]))
+    for start in range(0, matrix.shape[0], rows):
+        yield start, matrix[start:start + rows]
+
+
+def _index_tiles(indices: np.ndarray, columns: int, elements=_TILE_ELEMENTS):
+    """
+    :param indices: row indices
+    :param columns: number of columns of each row
+    :return: generator of (position, tile of indices) pairs, so that each tile of rows has about elements elements
+    """
+    rows = max(1, elements // max(1, columns))
+    for start in range(0, len(indices), rows):
+        yield start, indices[start:start + rows]
+
+
+def _min_plus_update(target: np.ndarray, left: np.ndarray, right: np.ndarray):
+    """
+    Update in place target with the min-plus product of left and right. The product is computed by chunks of rows
+    to bound the size of the temporary arrays.
+    :param target: matrix n x m
+    :param left: matrix n x k
+    :param right: matrix k x m
+    :return: void
+    """
+    rows = max(1, _BLOCK_ELEMENTS // max(1, right.size))
+    for first in range(0, target.shape[0], rows):
+        chunk = slice(first, first + rows)
+        product = np.min(left[chunk, :, None] + right[None, :, :], axis=1)
+        np.minimum(target[chunk], product, out=target[chunk])
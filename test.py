@@ -1,7 +1,20 @@
+import asyncio
+import json
 import os
+import tempfile
+import threading
+import time
+import numpy as np
 import src.utils.utilities as utils
 import src.retimer.retimer as rt
 import src.utils.generator as gn
+import src.wd.wd as wd
+from src.circuit import circuit as cr
+from src.instrument.instrument import APSP, PROBE, Recorder
+from src.opt.constraints import ConstraintSet
+from src.opt.cp import clock_period
+from src.service import service
+from src.utils import dot, export
 
 
 def random_test(test_path: str):
@@ -65,5 +78,317 @@ def correlator_test(correlator_dimension=None):
     print("All tests passed")
 
 
+def wd_engines_test(test_path: str):
+    """
+    Check that all the WD engines compute the same W and D matrices on the graphs of the given folder
+    """
+    path = os.getcwd() + '/' + test_path
+    for file in sorted(os.listdir(path)):
+        print(file)
+        circuit = rt.Retimer(utils.load_graph(path + '/' + file)).circuit
+        reference = wd.WD(circuit)
+        reference.wd()
+        for engine in [wd.FLOYD_WARSHALL, wd.PARALLEL]:
+            other = wd.WD(circuit, engine=engine)
+            other.wd()
+            assert np.array_equal(reference.w, other.w)
+            assert np.array_equal(reference.d, other.d)
+
+    print("All tests passed")
+
+
+def update_test(test_path: str):
+    """
+    Edit every graph of the given folder (slower gate, one more register, removed edge) and check that the
+    incremental update gives the same W, D and minimum clock as retiming the edited circuit from scratch
+    """
+    path = os.getcwd() + '/' + test_path
+    for file in sorted(os.listdir(path)):
+        print(file)
+        retimer = rt.Retimer(utils.load_graph(path + '/' + file))
+        retimer.retime('opt1')
+        circuit = retimer.circuit
+        edits = [(cr.COMPONENT_DELAY, 0, int(circuit.component_delay[0]) + 1),
+                 (cr.WIRE_DELAY, int(circuit.src[0]), int(circuit.dst[0]), int(circuit.wire_delay[0]) + 1),
+                 (cr.REMOVE_EDGE, int(circuit.src[-1]), int(circuit.dst[-1]))]
+        retimer.update(edits)
+
+        full = rt.Retimer(retimer.circuit)
+        full.retime('opt1')
+        assert np.array_equal(retimer.wd.w, full.wd.w)
+        assert np.array_equal(retimer.wd.d, full.wd.d)
+        assert retimer.opt.min_clock == full.opt.min_clock
+
+    print("All tests passed")
+
+
+def memmap_test(test_path: str):
+    """
+    Compute W and D of two graphs of the given folder out of core, in the same directory, and check that they match
+    the in-memory ones with the narrowest type able to hold them, also after an update of W and D read back from
+    the cache
+    """
+    path = os.getcwd() + '/' + test_path
+    files = sorted(os.listdir(path))
+    for first, second in zip(files, files[1:]):
+        print(first, second)
+        circuits = [utils.load_circuit(path + '/' + file) for file in (first, second)]
+        references = [wd.WD(circuit) for circuit in circuits]
+        for reference in references:
+            reference.wd()
+        with tempfile.TemporaryDirectory() as memmap_dir:
+            shared = [wd.WD(circuit, memmap_dir=memmap_dir) for circuit in circuits]
+            for matrices in shared:
+                matrices.wd()
+            assert shared[0].memmap_path != shared[1].memmap_path
+            for matrices, reference, circuit in zip(shared, references, circuits):
+                bound = max(int(np.sum(circuit.wire_delay)), int(np.sum(circuit.component_delay)) + 1)
+                assert matrices.w.dtype == wd.narrowest_dtype(bound)
+                assert np.array_equal(matrices.w, reference.w)
+                assert np.array_equal(matrices.d, reference.d)
+
+            with tempfile.TemporaryDirectory() as cache_dir:
+                rt.Retimer(circuits[0], cache_dir=cache_dir).retime('opt1')
+                retimer = rt.Retimer(circuits[0], wd_memmap_dir=memmap_dir, cache_dir=cache_dir)
+                retimer.retime('opt1')
+                assert retimer.wd.w.flags.writeable is False
+                edits = [(cr.COMPONENT_DELAY, 0, int(circuits[0].component_delay[0]) + 1)]
+                retimer.update(edits)
+                assert isinstance(retimer.wd.d, np.memmap) and retimer.wd.d.flags.writeable is True
+                full = wd.WD(retimer.circuit)
+                full.wd()
+                assert np.array_equal(retimer.wd.w, full.w)
+                assert np.array_equal(retimer.wd.d, full.d)
+
+    print("All tests passed")
+
+
+def retime_twice_test(test_path: str):
+    """
+    Retime every graph of the given folder several times with both algorithms and check that the retimed graph has
+    no negative register and the clock reported
+    """
+    path = os.getcwd() + '/' + test_path
+    for file in sorted(os.listdir(path)):
+        print(file)
+        retimer = rt.Retimer(utils.load_graph(path + '/' + file))
+        for optimizer in ('opt1', 'opt2', 'opt1'):
+            retimer.retime(optimizer)
+            retimed = rt.Retimer(retimer.retimed_graph.copy()).circuit
+            assert np.all(retimed.wire_delay >= 0)
+            assert clock_period(retimed, retimed.wire_delay)[0] == retimer.opt.min_clock
+
+    print("All tests passed")
+
+
+def search_test(test_path: str):
+    """
+    Check on the graphs of the given folder that the constraint set of OPT1 moved from clock to clock holds the
+    constraints of each clock, and that the warm start, the speculative and the batched search and the cache find
+    the same clock as the binary search, reporting a probe for each clock checked, none when read from the cache
+    """
+    path = os.getcwd() + '/' + test_path
+    for file in sorted(os.listdir(path)):
+        print(file)
+        circuit = utils.load_circuit(path + '/' + file)
+        reference = rt.Retimer(circuit)
+        reference.retime('opt1')
+        w, d = reference.wd.w, reference.wd.d
+
+        floor = int(np.max(circuit.component_delay))
+        constraints = ConstraintSet.from_matrices(w, d, floor)
+        for clock in np.random.permutation(np.unique(d[d > floor])).tolist() + [floor]:
+            constraints.update(clock)
+            sources, targets, weights = constraints.active()
+            rows, columns = np.nonzero(d > clock)
+            assert sorted(zip(sources.tolist(), targets.tolist(), weights.tolist())) == \
+                sorted(zip(rows.tolist(), columns.tolist(), (w[rows, columns] - 1).tolist()))
+            arcs = constraints.arcs(len(circuit))
+            assert np.all(np.diff(arcs.tails) >= 0) and len(arcs.tails) == len(sources)
+
+        for optimizer, options in (('opt1', {'warm_start': True}), ('opt1', {'search_jobs': 3}),
+                                   ('opt2', {'warm_start': True}), ('opt2', {'search_jobs': 3}),
+                                   ('opt2', {'batched': True})):
+            retimer = rt.Retimer(circuit)
+            retimer.retime(optimizer, **options)
+            assert retimer.opt.min_clock == reference.opt.min_clock
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            recorders = []
+            for _ in range(2):
+                recorders.append(Recorder())
+                retimer = rt.Retimer(circuit, cache_dir=cache_dir, instrument=recorders[-1])
+                retimer.retime('opt1')
+                assert retimer.opt.min_clock == reference.opt.min_clock
+                assert np.array_equal(retimer.wd.d, d)
+            probes = [event for event in recorders[0].events if event['event'] == PROBE]
+            assert all(event['feasible'] == (event['clock'] >= reference.opt.min_clock) for event in probes)
+            assert any(event['clock'] == reference.opt.min_clock for event in probes)
+            assert any(event['event'] == APSP for event in recorders[0].events)
+            assert not any(event['event'] in (APSP, PROBE) for event in recorders[1].events)
+
+    print("All tests passed")
+
+
+def min_area_test(test_path: str):
+    """
+    Retime every graph of the given folder with the fewest registers and check that the clock is still the minimum
+    one, that the registers never grow and that opt1 and opt2 end with the same number of registers
+    """
+    path = os.getcwd() + '/' + test_path
+    for file in sorted(os.listdir(path)):
+        print(file)
+        circuit = utils.load_circuit(path + '/' + file)
+        registers = []
+        for optimizer in ('opt1', 'opt2'):
+            retimer = rt.Retimer(circuit)
+            retimer.retime(optimizer, min_area=True)
+            clock, _ = retimer.opt._clock_period(retimer.opt.retimed_circuit.wire_delay)
+            assert clock == retimer.opt.min_clock
+            assert np.all(retimer.opt.retimed_circuit.wire_delay >= 0)
+            assert retimer.opt.registers[1] <= retimer.opt.registers[0]
+            registers.append(retimer.opt.registers[1])
+        assert registers[0] == registers[1]
+
+    print("All tests passed")
+
+
+def components_test(test_path: str, jobs=2):
+    """
+    Join all the graphs of the given folder, and a single node with a self-loop, in a circuit with many weakly
+    connected components, then check that retiming the components on their own, in memory and with memory-mapped W
+    and D, gives the same clock, retimings, registers and node names as retiming the whole circuit
+    """
+    path = os.getcwd() + '/' + test_path
+    circuits = [utils.load_circuit(path + '/' + file) for file in sorted(os.listdir(path))]
+    circuits.append(cr.Circuit([5], [0], [0], [2], ['self-loop']))
+    offsets = np.cumsum([0] + [len(circuit) for circuit in circuits])
+    joined = cr.Circuit(np.concatenate([circuit.component_delay for circuit in circuits]),
+                        np.concatenate([circuit.src + offset for circuit, offset in zip(circuits, offsets)]),
+                        np.concatenate([circuit.dst + offset for circuit, offset in zip(circuits, offsets)]),
+                        np.concatenate([circuit.wire_delay for circuit in circuits]),
+                        ['{}-{}'.format(index, name) for index, circuit in enumerate(circuits)
+                         for name in (circuit.names if circuit.names is not None else range(len(circuit)))])
+
+    for optimizer in ('opt1', 'opt2'):
+        for min_area in (False, True):
+            print(optimizer, 'min area' if min_area else '')
+            whole = rt.Retimer(joined)
+            whole.retime(optimizer, min_area=min_area)
+            with tempfile.TemporaryDirectory() as memmap_dir:
+                for options in ({}, {'wd_memmap_dir': memmap_dir}):
+                    split = rt.Retimer(joined, **options)
+                    split.retime(optimizer, min_area=min_area, components=True, component_jobs=jobs)
+                    assert split.opt.min_clock == whole.opt.min_clock
+                    assert np.array_equal(split.opt.retimings, whole.opt.retimings)
+                    assert split.opt.registers == whole.opt.registers
+                    assert list(split.retimed_graph.nodes) == list(whole.retimed_graph.nodes)
+
+    print("All tests passed")
+
+
+def export_test(test_path: str):
+    """
+    Retime every graph of the given folder, write it in each format of the exporter and check that reading it back
+    gives the retimed circuit
+    """
+    path = os.getcwd() + '/' + test_path
+    for file in sorted(os.listdir(path)):
+        print(file)
+        circuit = utils.load_circuit(path + '/' + file)
+        retimer = rt.Retimer(circuit)
+        retimer.retime('opt1')
+        retimed = retimer.opt.retimed_circuit
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'retimed')
+
+            export.export_retiming(circuit, retimer.opt.retimings, output + '.dot')
+            read = dot.read_circuit(output + '.dot')
+            assert read.names == [str(name) for name in retimed.names]
+            assert np.array_equal(read.component_delay, retimed.component_delay)
+            assert np.array_equal(read.src, retimed.src) and np.array_equal(read.dst, retimed.dst)
+            assert np.array_equal(read.wire_delay, retimed.wire_delay)
+
+            export.export_retiming(circuit, retimer.opt.retimings, output + '.npz')
+            read = cr.Circuit.load(output + '.npz')
+            for field in ('component_delay', 'src', 'dst', 'wire_delay', 'out_offsets', 'in_edges', 'in_offsets'):
+                assert np.array_equal(getattr(read, field), getattr(retimed, field))
+
+            export.export_retiming(circuit, retimer.opt.retimings, output + '.lags.npz')
+            retimings, src, dst, delta = export.read_lags(output + '.lags.npz')
+            assert np.array_equal(retimings, retimer.opt.retimings)
+            wire_delay = np.copy(circuit.wire_delay)
+            for v1, v2, registers in zip(src.tolist(), dst.tolist(), delta.tolist()):
+                wire_delay[circuit.edge_index(v1, v2)] += registers
+            assert np.array_equal(wire_delay, retimed.wire_delay)
+
+            export.export_retiming(circuit, retimer.opt.retimings, output + '.jsonl')
+            with open(output + '.jsonl') as lines:
+                records = [json.loads(line) for line in lines]
+            assert len(records) == 1 + len(circuit) + len(circuit.src)
+            assert records[0] == {'nodes': len(circuit), 'edges': len(circuit.src)}
+            assert [record['wire_delay'] for record in records[1 + len(circuit):]] == retimed.wire_delay.tolist()
+
+    print("All tests passed")
+
+
+def service_test(test_path: str):
+    """
+    Serve on a temporary socket and retime every graph of the given folder: the same circuit again must be answered
+    by the warm one, with other options it must be searched again without WD, and a circuit one edit away must be
+    moved from it with the same clock as a retiming from scratch. Check also that the edits found between the two circuits rebuild the edited one
+    """
+    path = os.getcwd() + '/' + test_path
+    with tempfile.TemporaryDirectory() as directory:
+        socket_path = os.path.join(directory, 'service.sock')
+        loop = asyncio.new_event_loop()
+        serving = loop.create_task(service.RetimingService().serve(path=socket_path))
+        thread = threading.Thread(target=_run_until_cancelled, args=(loop, serving))
+        thread.start()
+        try:
+            while not os.path.exists(socket_path):
+                time.sleep(0.01)
+            for file in sorted(os.listdir(path)):
+                print(file)
+                circuit = utils.load_circuit(path + '/' + file)
+                assert list(service.request({'path': path + '/' + file}, socket_path))[-1]['mode'] == service.COLD
+                assert list(service.request({'path': path + '/' + file}, socket_path))[-1]['mode'] == service.WARM
+                # other options search again on the W and D kept by the warm retimer
+                answers = list(service.request({'path': path + '/' + file, 'optimizer': 'opt2'}, socket_path))
+                assert answers[-1]['mode'] == service.SEARCH
+                assert not any(answer.get('phase') == APSP for answer in answers)
+                assert list(service.request({'path': path + '/' + file}, socket_path))[-1]['mode'] == service.SEARCH
+
+                edge = int(np.argmax(circuit.wire_delay))
+                edited = circuit.edit([(cr.WIRE_DELAY, int(circuit.src[edge]), int(circuit.dst[edge]),
+                                        int(circuit.wire_delay[edge]) + 1)])
+                edits = circuit.edits_to(edited)
+                assert len(edits) == 1
+                rebuilt = circuit.edit(edits)
+                for field in ('component_delay', 'src', 'dst', 'wire_delay'):
+                    assert np.array_equal(getattr(rebuilt, field), getattr(edited, field))
+
+                arrays = {'component_delay': edited.component_delay, 'src': edited.src, 'dst': edited.dst,
+                          'wire_delay': edited.wire_delay, 'names': edited.names}
+                result = list(service.request({'circuit': arrays}, socket_path))[-1]
+                cold = rt.Retimer(edited)
+                cold.retime('opt1')
+                assert result['mode'] == service.UPDATE
+                assert result['min_clock'] == cold.opt.min_clock
+        finally:
+            loop.call_soon_threadsafe(serving.cancel)
+            thread.join()
+            loop.close()
+
+    print("All tests passed")
+
+
+def _run_until_cancelled(loop, task):
+    try:
+        loop.run_until_complete(task)
+    except asyncio.CancelledError:
+        pass
+
+
 if __name__ == '__main__':
     random_test('rand-graphs/clean/50')
\ No newline at end of file